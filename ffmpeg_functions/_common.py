@@ -0,0 +1,372 @@
+"""
+Helpers shared by every FFmpeg function script.
+
+The scripts add this directory to sys.path and import from here, so the FFmpeg binaries
+are resolved once per process and the parameter/result plumbing lives in one place.
+"""
+import sys
+import os
+import json
+import subprocess
+import shutil
+import tempfile
+import io
+import mmap
+import binascii
+import threading
+from collections import deque
+
+try:
+    import orjson # Faster JSON parsing and serialization when available
+except ImportError:
+    orjson = None
+
+try:
+    import pybase64 # SIMD base64 encoder, several times faster than binascii on large outputs
+except ImportError:
+    pybase64 = None
+
+try:
+    import fcntl # Only on POSIX; used to enlarge the FFmpeg output pipe on Linux
+except ImportError:
+    fcntl = None
+
+try:
+    import av # PyAV reads container headers in-process, without spawning ffprobe
+except ImportError:
+    av = None
+
+# Resolve the binaries once instead of letting every spawn scan PATH again.
+# FFMPEG_BINARY / FFPROBE_BINARY pick a specific install when several are present.
+FFMPEG = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFMPEG = shutil.which(FFMPEG) or FFMPEG
+FFPROBE = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+FFPROBE = shutil.which(FFPROBE) or FFPROBE
+
+def run_command(command, **kwargs):
+    """Runs a command to completion, raising CalledProcessError on failure and capturing its text output."""
+    # Never hand over our stdin: FFmpeg reads it for keyboard commands, and in the worker it carries the requests
+    return subprocess.run(command, check=True, capture_output=True, text=True, stdin=subprocess.DEVNULL, **kwargs)
+
+# Only the end of FFmpeg's stderr is kept; that is where the error is, and long runs can log megabytes.
+STDERR_TAIL_LINES = 512
+
+def run_ffmpeg(command):
+    """Runs an FFmpeg command to completion, keeping only the tail of its stderr for error reporting."""
+    # Text mode splits on FFmpeg's \r progress updates as well, so each one is its own line
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    stderr_tail = deque(process.stderr, maxlen=STDERR_TAIL_LINES)
+    return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command, stderr=''.join(stderr_tail))
+
+def drain_stderr(process):
+    """Reads a process's binary stderr on a background thread, keeping its last lines. Returns the thread and the lines."""
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    stream = io.TextIOWrapper(process.stderr, errors='replace')
+    stderr_reader = threading.Thread(target=lambda: stderr_tail.extend(stream))
+    stderr_reader.start()
+    return stderr_reader, stderr_tail
+
+def load_params(params_path):
+    """Reads the JSON parameters file."""
+    with open(params_path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def write_json(payload):
+    """Writes a JSON payload to stdout, using orjson when it is installed."""
+    global _payload_open
+    if _payload_open:
+        # A binary payload was cut short by an error. Finish its line with this payload's keys instead of
+        # starting a new one, so the node still gets exactly one parseable line that carries the error.
+        _payload_open = False
+        body = orjson.dumps(payload) if orjson else json.dumps(payload).encode('utf-8')
+        sys.stdout.buffer.write(b'", ' + body[1:] + b"\n")
+        sys.stdout.buffer.flush()
+        return
+    if orjson:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(orjson.dumps(payload) + b"\n")
+        sys.stdout.buffer.flush()
+    else:
+        print(json.dumps(payload))
+
+def get_file_path(params, base_name):
+    """Extracts the file path from the parameters."""
+    if params.get(f"{base_name}UseFilePath"):
+        path = params.get(f"{base_name}FilePath")
+        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
+        return path
+    else:
+        path = params.get(f"{base_name}BinaryPropertyName")
+        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
+        return path
+
+# Only the container header is needed, so don't let the demuxer read ahead into the media data.
+PROBE_OPTIONS = {'probesize': '32K', 'analyzeduration': '0'}
+
+def describe_stream(stream):
+    """Builds an ffprobe-style stream entry from a PyAV stream."""
+    ctx = stream.codec_context
+    entry = {'codec_type': stream.type, 'codec_name': getattr(ctx, 'name', None)}
+    if stream.type == 'video':
+        entry.update(width=getattr(ctx, 'width', None), height=getattr(ctx, 'height', None),
+                     pix_fmt=getattr(ctx, 'pix_fmt', None))
+    elif stream.type == 'audio':
+        entry.update(sample_rate=getattr(ctx, 'sample_rate', None), channels=getattr(ctx, 'channels', None))
+    return entry
+
+def probe_media(file_path):
+    """Returns ffprobe-style format and stream info, using PyAV in-process when available.
+
+    A missing input raises FileNotFoundError; a missing ffprobe binary raises a plain OSError.
+    """
+    if av is not None:
+        try:
+            with av.open(file_path, options=PROBE_OPTIONS) as container:
+                duration = container.duration / av.time_base if container.duration else 0
+                streams = [describe_stream(s) for s in container.streams]
+            return {'format': {'duration': duration}, 'streams': streams}
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            sys.stderr.write(f"PyAV could not open {file_path}, falling back to ffprobe: {e}\n")
+
+    command = [
+        FFPROBE, '-v', 'quiet',
+        '-probesize', PROBE_OPTIONS['probesize'], '-analyzeduration', PROBE_OPTIONS['analyzeduration'],
+        '-print_format', 'json',
+        '-show_format', '-show_streams', file_path
+    ]
+    try:
+        result = run_command(command)
+    except subprocess.CalledProcessError:
+        # ffprobe runs quietly, so only look for the file once the probe has already failed
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"No such file: {file_path}")
+        raise
+    except FileNotFoundError as e:
+        # A missing ffprobe binary must not read as a missing input
+        raise OSError(f"Could not run ffprobe: {e}")
+    return json.loads(result.stdout)
+
+def probe_duration(file_path):
+    """Returns a media file's duration in seconds, or None if it can't be determined."""
+    try:
+        duration = float(probe_media(file_path).get('format', {}).get('duration', 0))
+    except (subprocess.CalledProcessError, ValueError, OSError) as e:
+        sys.stderr.write(f"Error getting duration for {file_path}: {e}\n")
+        return None
+    return duration or None
+
+# True while a {"binary_data": "... line is half-written to stdout; see write_json
+_payload_open = False
+
+def begin_binary_payload():
+    """Opens a base64 JSON payload on stdout."""
+    global _payload_open
+    sys.stdout.flush()
+    sys.stdout.buffer.write(b'{"binary_data": "')
+    _payload_open = True
+
+def end_binary_payload(file_name):
+    """Closes the open base64 JSON payload with the output's file name."""
+    global _payload_open
+    out = sys.stdout.buffer
+    out.write(f'", "file_name": {json.dumps(file_name)}}}\n'.encode('utf-8'))
+    out.flush()
+    _payload_open = False
+
+BASE64_CHUNK_SIZE = 57 * 1024 # A multiple of 3, so each chunk encodes without padding
+# Piped output is read in larger blocks than files; still a multiple of 3 so each block encodes without padding.
+PIPE_READ_SIZE = 16 * BASE64_CHUNK_SIZE
+PIPE_BUFFER_SIZE = 1024 * 1024 # Linux's default cap for unprivileged pipe resizing
+
+def encode_base64(data):
+    """Base64-encodes one chunk without a trailing newline, using pybase64 when it is installed."""
+    if pybase64 is not None:
+        return pybase64.b64encode(data)
+    return binascii.b2a_base64(data, newline=False)
+
+def make_handoff_path(file_name):
+    """Creates a unique temp file for an output that the node will read, and delete, by path."""
+    fd, path = tempfile.mkstemp(prefix='ffmpeg_', suffix=os.path.splitext(file_name)[1])
+    os.close(fd)
+    return path
+
+def write_binary_output(output_path):
+    """Streams a file to stdout as a base64 JSON payload without holding it in memory."""
+    out = sys.stdout.buffer
+    begin_binary_payload()
+    with open(output_path, 'rb') as f:
+        # Map the file instead of reading it so the OS pages it in on demand with no Python-side copy.
+        # Empty files cannot be mapped, and have nothing to encode anyway.
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(0, len(mm), BASE64_CHUNK_SIZE):
+                    out.write(encode_base64(mm[offset:offset + BASE64_CHUNK_SIZE]))
+    end_binary_payload(os.path.basename(output_path))
+
+# Muxer arguments that let each container be written to a non-seekable pipe.
+PIPE_MUXERS = {
+    '.mp4': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov'],
+    '.m4a': ['-f', 'ipod', '-movflags', 'frag_keyframe+empty_moov'],
+    '.mov': ['-f', 'mov', '-movflags', 'frag_keyframe+empty_moov'],
+    '.mkv': ['-f', 'matroska'],
+    '.webm': ['-f', 'webm'],
+    '.mp3': ['-f', 'mp3'],
+    '.ogg': ['-f', 'ogg'],
+    '.aac': ['-f', 'adts'],
+}
+
+def stream_ffmpeg_output(command, file_name):
+    """Runs an FFmpeg command that writes to pipe:1 and streams its output to stdout as a base64 JSON payload."""
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Drain stderr on a separate thread so a chatty FFmpeg can't block on a full pipe.
+    stderr_reader, stderr_tail = drain_stderr(process)
+
+    if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+        # A larger pipe lets FFmpeg run further ahead, so both sides wake each other far less often
+        try:
+            fcntl.fcntl(process.stdout.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+        except OSError:
+            pass
+
+    out = sys.stdout.buffer
+    started = False
+    # One buffer reused for every read; readinto fills it completely except at EOF, keeping chunks a multiple of 3
+    buffer = bytearray(PIPE_READ_SIZE)
+    view = memoryview(buffer)
+    while True:
+        n = process.stdout.readinto(buffer)
+        if not n:
+            break
+        if not started:
+            # Only open the payload once FFmpeg has produced data, so early failures still report cleanly.
+            # A failure after this point is written into the open payload by write_json.
+            begin_binary_payload()
+            started = True
+        out.write(encode_base64(view[:n]))
+
+    return_code = process.wait()
+    stderr_reader.join()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command, stderr=''.join(stderr_tail))
+
+    if not started:
+        begin_binary_payload()
+    end_binary_payload(file_name)
+
+# Hardware H.264 encoders in order of preference, each with the arguments it needs.
+HARDWARE_H264_ENCODERS = [
+    ('h264_nvenc', ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'hq', '-pix_fmt', 'yuv420p']),
+    ('h264_qsv', ['-c:v', 'h264_qsv', '-pix_fmt', 'nv12']),
+    ('h264_videotoolbox', ['-c:v', 'h264_videotoolbox', '-pix_fmt', 'yuv420p']),
+    ('h264_vaapi', ['-c:v', 'h264_vaapi']),
+]
+SOFTWARE_H264_ARGS = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+# Containers whose video is written as H.264; others keep FFmpeg's default codec.
+H264_CONTAINERS = {'.mp4', '.m4v', '.mov', '.mkv'}
+# Values of the 'hwaccel' parameter and the encoder each one selects
+HWACCEL_ENCODERS = {'nvenc': 'h264_nvenc', 'qsv': 'h264_qsv', 'videotoolbox': 'h264_videotoolbox', 'vaapi': 'h264_vaapi'}
+# VAAPI only encodes GPU surfaces, so it needs a device before the inputs and the filtered frames
+# uploaded to it. Callers add both themselves and say so, which is why auto-detection never picks it.
+VAAPI_INPUT_ARGS = ['-vaapi_device', '/dev/dri/renderD128']
+VAAPI_UPLOAD_FILTER = 'format=nv12,hwupload'
+HW_ENCODER_CACHE_PATH = os.path.join(tempfile.gettempdir(), "yak_ffmpeg_hw_encoders.json")
+
+def encoder_works(name, codec_args):
+    """Checks that an encoder actually opens on this machine by encoding a few blank frames."""
+    input_args, video_filter = (VAAPI_INPUT_ARGS, VAAPI_UPLOAD_FILTER) if name == 'h264_vaapi' else ([], 'null')
+    command = [
+        FFMPEG, '-hide_banner', '-v', 'error'
+    ] + input_args + [
+        '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1', '-vf', video_filter
+    ] + codec_args + ['-f', 'null', '-']
+    try:
+        subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, check=True, timeout=30)
+        return True
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        return False
+
+def detect_hardware_encoders():
+    """Returns the hardware H.264 encoders that work on this machine, cached on disk per FFmpeg binary."""
+    # The candidate list is part of the key, so adding an encoder invalidates older caches
+    candidates = ','.join(name for name, _ in HARDWARE_H264_ENCODERS)
+    try:
+        cache_key = f"{FFMPEG}|{os.stat(FFMPEG).st_mtime_ns}|{candidates}"
+    except OSError:
+        cache_key = f"{FFMPEG}|{candidates}"
+
+    try:
+        with open(HW_ENCODER_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+        if cache.get('key') == cache_key and isinstance(cache.get('working'), list):
+            return cache['working']
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        result = run_command([FFMPEG, '-hide_banner', '-encoders'])
+        available = result.stdout
+    except (subprocess.CalledProcessError, OSError):
+        available = ""
+
+    # Being compiled in doesn't mean the hardware is present, so each candidate gets a test encode.
+    working = [
+        name for name, codec_args in HARDWARE_H264_ENCODERS
+        if f" {name} " in available and encoder_works(name, codec_args)
+    ]
+
+    try:
+        with open(HW_ENCODER_CACHE_PATH, 'w') as f:
+            json.dump({'key': cache_key, 'working': working}, f)
+    except OSError as e:
+        sys.stderr.write(f"Could not write encoder cache {HW_ENCODER_CACHE_PATH}: {e}\n")
+    return working
+
+def get_h264_codec_args(hwaccel='auto', vaapi_upload=False):
+    """Returns the codec arguments for the requested H.264 encoder, falling back to libx264.
+
+    VAAPI is only used when the caller says it adds VAAPI_INPUT_ARGS and VAAPI_UPLOAD_FILTER itself.
+    """
+    if not hwaccel or hwaccel == 'none':
+        return SOFTWARE_H264_ARGS
+    if hwaccel == 'vaapi' and not vaapi_upload:
+        sys.stderr.write("The VAAPI encoder isn't supported by this function, using libx264.\n")
+        return SOFTWARE_H264_ARGS
+    working = detect_hardware_encoders()
+    if hwaccel == 'auto':
+        encoder = next((name for name in working if name != 'h264_vaapi'), None)
+    else:
+        encoder = HWACCEL_ENCODERS.get(hwaccel)
+        if encoder not in working:
+            sys.stderr.write(f"Hardware encoder '{hwaccel}' is not available, using libx264.\n")
+            encoder = None
+    return dict(HARDWARE_H264_ENCODERS).get(encoder, SOFTWARE_H264_ARGS)
+
+# Crop/pad offsets for each anchor, keyed by the lowercased anchor name without spaces.
+# Pad offsets use ow/oh (the padded size) so neither table depends on the requested dimensions.
+CROP_POSITIONS = {
+    'center': ('(iw-ow)/2', '(ih-oh)/2'),
+    'top': ('(iw-ow)/2', '0'),
+    'bottom': ('(iw-ow)/2', '(ih-oh)'),
+    'left': ('0', '(ih-oh)/2'),
+    'right': ('(iw-ow)', '(ih-oh)/2'),
+    'topleft': ('0', '0'),
+    'topright': ('(iw-ow)', '0'),
+    'bottomleft': ('0', '(ih-oh)'),
+    'bottomright': ('(iw-ow)', '(ih-oh)'),
+}
+PAD_POSITIONS = {
+    'center': ('(ow-iw)/2', '(oh-ih)/2'),
+    'top': ('(ow-iw)/2', '0'),
+    'bottom': ('(ow-iw)/2', '(oh-ih)'),
+    'left': ('0', '(oh-ih)/2'),
+    'right': ('(ow-iw)', '(oh-ih)/2'),
+    'topleft': ('0', '0'),
+    'topright': ('(ow-iw)', '0'),
+    'bottomleft': ('0', '(oh-ih)'),
+    'bottomright': ('(ow-iw)', '(oh-ih)'),
+}
@@ -0,0 +1,73 @@
+"""
+Long-running worker that serves the FFmpeg functions to the n8n node.
+
+Reads one JSON request per line from stdin, {"op": <function value>, "params": {...}},
+runs the matching module's run(params) and writes exactly one JSON line per request
+to stdout. The modules are the same logic.py scripts the node can also spawn on their
+own; here they are imported once and reused, so a batch of items pays for one Python
+start-up instead of one per item.
+"""
+import sys
+import json
+import os
+import importlib.util
+
+from _common import orjson, write_json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANIFEST_PATH = os.path.join(REPO_ROOT, 'ffmpeg_node_manifest.json')
+
+def load_dispatch():
+    """Maps the value of every manifest function marked "worker": true to its script path."""
+    with open(MANIFEST_PATH, 'rb') as f:
+        manifest = json.loads(f.read())
+    return {
+        func['value']: os.path.join(REPO_ROOT, func['scriptFile'])
+        for func in manifest.get('functions', [])
+        if func.get('worker')
+    }
+
+DISPATCH = load_dispatch()
+_modules = {}
+
+def get_module(op):
+    """Imports a function's logic.py on first use and keeps it for later requests."""
+    module = _modules.get(op)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(f"yak_{op}", DISPATCH[op])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[op] = module
+    return module
+
+def handle(request):
+    """Runs one request and makes sure it produces exactly one line of output."""
+    op = request.get('op') if isinstance(request, dict) else None
+    if op not in DISPATCH:
+        write_json({"error": f"Unknown function: {op}"})
+        return
+    try:
+        result = get_module(op).run(request.get('params') or {})
+    except SystemExit:
+        # The modules write their error as a JSON line before exiting
+        return
+    except Exception as e:
+        write_json({"error": f"{type(e).__name__}: {e}"})
+        return
+    if result is not None:
+        write_json(result)
+
+def serve():
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            request = orjson.loads(line) if orjson else json.loads(line)
+        except ValueError as e:
+            write_json({"error": f"Invalid request: {e}"})
+            continue
+        handle(request)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    serve()
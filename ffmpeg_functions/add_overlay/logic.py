@@ -3,44 +3,90 @@ import json
 import subprocess
 import tempfile
 import os
-import base64
-
-def get_media_info(file_path):
-    """Gets media information like duration and stream types using ffprobe."""
-    command = [
-        'ffprobe', '-v', 'quiet', '-print_format', 'json',
-        '-show_format', '-show_streams', file_path
-    ]
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, load_params, write_json, run_ffmpeg, PIPE_MUXERS, SOFTWARE_H264_ARGS, get_h264_codec_args, make_handoff_path, probe_media, stream_ffmpeg_output, write_binary_output
+
+# Probe results persist across runs, keyed by path and invalidated when the file's mtime or size changes.
+PROBE_CACHE_PATH = os.path.join(tempfile.gettempdir(), "yak_ffprobe_cache.json")
+PROBE_CACHE_MAX_ENTRIES = 512
+_probe_cache_lock = threading.Lock()
+
+# Audio codecs each output container accepts as-is, letting a single audio layer skip re-encoding.
+AUDIO_COPY_CODECS = {
+    '.mp4': {'aac', 'mp3'},
+    '.mov': {'aac', 'mp3'},
+    '.m4a': {'aac'},
+    '.mkv': {'aac', 'mp3'},
+    '.mp3': {'mp3'},
+}
+
+def load_probe_cache():
+    """Loads the on-disk probe cache, treating a missing or corrupt file as empty."""
+    try:
+        with open(PROBE_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_probe_cache(cache):
+    """Atomically writes the probe cache, dropping the oldest entries beyond the size cap."""
+    while len(cache) > PROBE_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    temp_path = f"{PROBE_CACHE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, PROBE_CACHE_PATH)
+    except OSError as e:
+        sys.stderr.write(f"Could not write probe cache {PROBE_CACHE_PATH}: {e}\n")
+
+@functools.lru_cache(maxsize=128)
+def cached_probe(file_path, mtime_ns, size):
+    """Probes a file once per (path, mtime, size), consulting the on-disk cache before probing."""
+    with _probe_cache_lock:
+        entry = load_probe_cache().get(file_path)
+    if entry and entry.get('mtime_ns') == mtime_ns and entry.get('size') == size:
+        return entry['info']
+
+    info = probe_media(file_path)
+    with _probe_cache_lock:
+        cache = load_probe_cache()
+        cache.pop(file_path, None)
+        cache[file_path] = {'mtime_ns': mtime_ns, 'size': size, 'info': info}
+        save_probe_cache(cache)
+    return info
+
+def get_media_info(file_path, st=None):
+    """Gets media information like duration and stream types, reusing the caller's stat result if given."""
     try:
-        is_windows = sys.platform == "win32"
-        result = subprocess.run(command, capture_output=True, text=True, check=True, shell=is_windows)
-        info = json.loads(result.stdout)
+        if st is None:
+            st = os.stat(file_path)
+        info = cached_probe(file_path, st.st_mtime_ns, st.st_size)
         
         duration = float(info.get('format', {}).get('duration', 0))
         has_video = any(s['codec_type'] == 'video' for s in info.get('streams', []))
-        has_audio = any(s['codec_type'] == 'audio' for s in info.get('streams', []))
+        audio_codecs = [s.get('codec_name') for s in info.get('streams', []) if s['codec_type'] == 'audio']
+        has_audio = bool(audio_codecs)
         is_image = has_video and duration < 0.1
 
-        return {'duration': duration, 'has_video': has_video, 'has_audio': has_audio, 'is_image': is_image}
-    except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError) as e:
+        return {
+            'duration': duration, 'has_video': has_video, 'has_audio': has_audio, 'is_image': is_image,
+            'audio_codec': audio_codecs[0] if audio_codecs else None
+        }
+    except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError, OSError) as e:
         sys.stderr.write(f"Error probing file {file_path}: {e}\n")
         return None
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
-
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     layers = []
     # --- 1. Dynamically Parse Layers ---
+    candidates = []
     for i in range(1, 11): # Loop from layer 1 to 10
         is_binary_key = f"layer{i}IsBinary"
         binary_prop_key = f"layer{i}BinaryPropertyName"
@@ -53,8 +99,22 @@ def main():
             path = params.get(file_path_key)
 
         # If a path exists for this layer, process it. Otherwise, skip.
-        if path and os.path.exists(path):
-            info = get_media_info(path)
+        if not path:
+            continue
+        try:
+            candidates.append((i, path, os.stat(path)))
+        except OSError:
+            continue
+
+    # Probe each distinct file once, all concurrently; PyAV releases the GIL while
+    # parsing headers and the ffprobe fallback just waits on its own process.
+    if candidates:
+        unique_stats = {path: st for _, path, st in candidates}
+        with ThreadPoolExecutor(max_workers=len(unique_stats)) as executor:
+            infos = dict(zip(unique_stats, executor.map(get_media_info, unique_stats, unique_stats.values())))
+
+        for i, path, _ in candidates:
+            info = infos[path]
             if info:
                 layers.append({
                     'path': path,
@@ -64,7 +124,7 @@ def main():
                 })
 
     if not layers:
-        print(json.dumps({"error": "No valid media layers provided."}))
+        write_json({"error": "No valid media layers provided."})
         sys.exit(1)
 
     # --- 2. Determine Final Duration ---
@@ -83,75 +143,110 @@ def main():
         final_duration = 10 # Default for image-only or indeterminate compositions
 
     # --- 3. Build FFmpeg Command Inputs ---
+    has_any_video = any(layer['info']['has_video'] for layer in layers)
+    video_codec_args = get_h264_codec_args(params.get('hwaccel', 'auto')) if has_any_video else None
+    use_hardware = video_codec_args is not None and video_codec_args is not SOFTWARE_H264_ARGS
+
     inputs = []
     video_streams, audio_streams = [], []
     for i, layer in enumerate(layers):
         if layer['info']['is_image'] or (layer['loop'] and layer is not trim_master_layer):
             inputs.extend(['-loop', '1'])
+        elif use_hardware and layer['info']['has_video']:
+            inputs.extend(['-hwaccel', 'auto'])
         inputs.extend(['-i', layer['path']])
         
         if layer['info']['has_video']: video_streams.append(f"[{i}:v]")
         if layer['info']['has_audio']: audio_streams.append(f"[{i}:a]")
 
     # --- 4. Build Filter Complex ---
-    filter_complex = ""
+    filter_parts = []
     final_video_map, final_audio_map = None, None
 
     if len(video_streams) > 1:
-        last_video_out = video_streams[0]
+        # Pin pixel formats and SAR up front so the overlays don't negotiate conversions per frame.
+        filter_parts.append(f"{video_streams[0]}format=yuv420p,setsar=1[base]")
+        for i in range(1, len(video_streams)):
+            filter_parts.append(f"{video_streams[i]}format=yuva420p,setsar=1[lay{i}]")
+        last_video_out = "[base]"
         for i in range(1, len(video_streams)):
-            next_out = f"v{i}" if i < len(video_streams) else "vout"
-            filter_complex += f"{last_video_out}{video_streams[i]}overlay[ {next_out}];"
+            next_out = f"v{i}"
+            filter_parts.append(f"{last_video_out}[lay{i}]overlay=format=yuv420[{next_out}]")
             last_video_out = f"[{next_out}]"
+        filter_parts.append(f"{last_video_out}format=yuv420p[vout]")
         final_video_map = "[vout]"
     elif len(video_streams) == 1:
-        filter_complex += f"{video_streams[0]}copy[vout];"
+        filter_parts.append(f"{video_streams[0]}copy[vout]")
         final_video_map = "[vout]"
 
     if len(audio_streams) > 1:
         amix_inputs = "".join(audio_streams)
-        filter_complex += f"{amix_inputs}amix=inputs={len(audio_streams)}:duration=longest[aout]"
+        filter_parts.append(f"{amix_inputs}amix=inputs={len(audio_streams)}:duration=longest[aout]")
         final_audio_map = "[aout]"
     elif len(audio_streams) == 1:
-        filter_complex += f"{audio_streams[0]}acopy[aout];"
-        final_audio_map = "[aout]"
+        # A lone audio stream needs no filtering; map it directly so it can be stream-copied.
+        final_audio_map = f"{audio_streams[0][1:-1]}:0"
+
+    filter_complex = ";".join(filter_parts)
 
     # --- 5. Determine Output Path and Execute ---
     output_as_binary = params.get('outputAsBinary', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     
     try:
         if not output_as_binary:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
             ext = ".mp4" if final_video_map else ".mp3"
-            output_path = os.path.join(temp_dir, f"ffmpeg_multilayer_output{ext}")
+            file_name = f"ffmpeg_multilayer_output{ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped, skipping the temp file.
+                pipe_muxer = PIPE_MUXERS.get(ext)
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
 
-        command = ['ffmpeg', '-y'] + inputs
+        command = [FFMPEG, '-y'] + inputs
         if filter_complex: command.extend(['-filter_complex', filter_complex])
         if final_video_map: command.extend(['-map', final_video_map])
         if final_audio_map: command.extend(['-map', final_audio_map])
         command.extend(['-t', str(final_duration)])
-        if final_video_map: command.extend(['-c:v', 'libx264', '-pix_fmt', 'yuv420p'])
-        if final_audio_map: command.extend(['-c:a', 'aac'])
+        if final_video_map: command.extend(video_codec_args)
+        if final_audio_map:
+            output_ext = os.path.splitext(output_path or file_name)[1].lower()
+            audio_layer = next(layer for layer in layers if layer['info']['has_audio'])
+            if len(audio_streams) == 1 and audio_layer['info'].get('audio_codec') in AUDIO_COPY_CODECS.get(output_ext, ()):
+                command.extend(['-c:a', 'copy'])
+            else:
+                command.extend(['-c:a', 'libmp3lame' if output_ext == '.mp3' else 'aac'])
+
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
         command.append(output_path)
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        run_ffmpeg(command)
         
-        if output_as_binary:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif output_as_binary:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path, "duration": final_duration}))
+             return {"output_path": output_path, "duration": final_duration}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
         if output_as_binary and output_path and os.path.exists(output_path):
@@ -160,5 +255,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
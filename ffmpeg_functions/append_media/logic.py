@@ -3,44 +3,109 @@ import json
 import subprocess
 import tempfile
 import os
-import base64
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, FFPROBE, run_command, load_params, write_json, run_ffmpeg, PIPE_MUXERS, make_handoff_path, probe_media, stream_ffmpeg_output, write_binary_output
+
+STREAM_SIGNATURE_KEYS = {
+    'video': ('codec_name', 'width', 'height', 'pix_fmt'),
+    'audio': ('codec_name', 'sample_rate', 'channels'),
+}
+
+# The full set of parameters that must match before files can be joined by stream copy. Decoders keep
+# the first file's codec setup (H.264 SPS/PPS, AAC config), so the extradata has to be identical too.
+SPLICE_SIGNATURE_KEYS = {
+    'video': ('codec_name', 'profile', 'level', 'width', 'height', 'pix_fmt', 'r_frame_rate', 'time_base', 'extradata_hash'),
+    'audio': ('codec_name', 'profile', 'sample_rate', 'channels', 'time_base', 'extradata_hash'),
+}
+# Values ffprobe reports when it couldn't work a parameter out
+UNKNOWN_VALUES = {'None', '', 'unknown', '0/0', 'N/A'}
+
+def stream_signature(streams, codec_type, keys=STREAM_SIGNATURE_KEYS):
+    """Returns the codec parameters of the first stream of a type, or None if it has none."""
+    stream = next((s for s in streams if s.get('codec_type') == codec_type), None)
+    if stream is None:
+        return None
+    # ffprobe reports some numbers as strings, so compare everything as text
+    return tuple(str(stream.get(key)) for key in keys[codec_type])
+
+def get_splice_signature(file_path):
+    """Returns the full video and audio parameters of a file, probed without the header-only size limits."""
+    command = [FFPROBE, '-v', 'error', '-show_data_hash', 'sha256', '-show_streams', '-of', 'json', file_path]
+    streams = json.loads(run_command(command).stdout).get('streams', [])
+    return (stream_signature(streams, 'video', SPLICE_SIGNATURE_KEYS),
+            stream_signature(streams, 'audio', SPLICE_SIGNATURE_KEYS))
 
 def get_media_info(file_path):
-    """Gets media information, returning None for images."""
-    command = [
-        'ffprobe', '-v', 'quiet', '-print_format', 'json',
-        '-show_format', '-show_streams', file_path
-    ]
+    """Gets media information, returning None for images. A missing file raises FileNotFoundError."""
     try:
-        is_windows = sys.platform == "win32"
-        result = subprocess.run(command, capture_output=True, text=True, check=True, shell=is_windows)
-        info = json.loads(result.stdout)
+        info = probe_media(file_path)
         
-        has_video = any(s['codec_type'] == 'video' for s in info.get('streams', []))
-        has_audio = any(s['codec_type'] == 'audio' for s in info.get('streams', []))
+        streams = info.get('streams', [])
+        has_video = any(s['codec_type'] == 'video' for s in streams)
+        has_audio = any(s['codec_type'] == 'audio' for s in streams)
         
         # This function does not support images
         if has_video and not has_audio and float(info.get('format', {}).get('duration', 1)) < 0.1:
             return None
 
-        return {'has_video': has_video, 'has_audio': has_audio}
+        return {
+            'has_video': has_video,
+            'has_audio': has_audio,
+            'video_signature': stream_signature(streams, 'video'),
+            'audio_signature': stream_signature(streams, 'audio'),
+        }
+    except FileNotFoundError:
+        raise
     except Exception as e:
         sys.stderr.write(f"Error probing file {file_path}: {e}\n")
         return None
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
+def can_concat_demux(paths, infos, output_ext):
+    """
+    Checks whether the inputs can be joined with the concat demuxer and stream copy:
+    every file must share the container of the output and the full codec parameters,
+    down to the profile, level, frame rate, time base and extradata. Anything unknown
+    falls back to the concat filter, which re-encodes.
+    """
+    exts = {os.path.splitext(path)[1].lower() for path in paths}
+    if exts != {output_ext.lower()}:
+        return False
+    # The quick header probe rules out most mismatches without another process per file
+    signatures = {(info['video_signature'], info['audio_signature']) for info in infos}
+    if len(signatures) != 1:
+        return False
+    if any(UNKNOWN_VALUES.intersection(signature) for signature in next(iter(signatures)) if signature):
+        return False
+
     try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+        signatures = {get_splice_signature(path) for path in paths}
+    except (subprocess.CalledProcessError, ValueError, OSError) as e:
+        sys.stderr.write(f"Could not probe the inputs for stream copy, re-encoding instead: {e}\n")
+        return False
+    if len(signatures) != 1:
+        return False
+    video_signature, audio_signature = next(iter(signatures))
+    # Frame rate and time base are the ones a probe can leave unknown; profile, level and extradata
+    # are legitimately absent for some codecs and only need to be absent in every file alike.
+    known = []
+    if video_signature:
+        keys = SPLICE_SIGNATURE_KEYS['video']
+        known += [video_signature[keys.index('r_frame_rate')], video_signature[keys.index('time_base')]]
+    if audio_signature:
+        known.append(audio_signature[SPLICE_SIGNATURE_KEYS['audio'].index('time_base')])
+    return not UNKNOWN_VALUES.intersection(known)
+
+def write_concat_list(paths):
+    """Writes a concat demuxer list file and returns its path."""
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', prefix='ffmpeg_append_', delete=False, encoding='utf-8') as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        return f.name
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         media_files_str = params.get('mediaFilesJson')
         if not media_files_str:
@@ -51,43 +116,48 @@ def main():
             raise ValueError("The input must be a JSON array with at least two media files.")
 
     except (ValueError, json.JSONDecodeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     # --- 1. Process and Validate Media List ---
     inputs = []
+    paths = []
+    infos = []
     filter_complex_parts = []
     stream_counter = 0
     
-    # Check if all files are of the same primary type (all video or all audio)
-    first_file_info = get_media_info(media_list[0].get('path'))
-    if not first_file_info:
-        print(json.dumps({"error": f"Could not process the first file: {media_list[0].get('path')}"}))
-        sys.exit(1)
-    
-    is_video_concat = first_file_info['has_video']
-    is_audio_concat = first_file_info['has_audio'] and not is_video_concat
+    is_video_concat = is_audio_concat = False
 
     for i, media in enumerate(media_list):
         path = media.get('path')
-        if not path or not os.path.exists(path):
-            print(json.dumps({"error": f"File path for item {i} is invalid or missing."}))
+        # The probe reports a missing file itself, so there is no separate existence check
+        try:
+            if not path:
+                raise FileNotFoundError(path)
+            info = get_media_info(path)
+        except FileNotFoundError:
+            write_json({"error": f"File path for item {i} is invalid or missing."})
             sys.exit(1)
-        
-        info = get_media_info(path)
         if not info:
-            print(json.dumps({"error": f"Could not process file (or file is an image): {path}"}))
+            write_json({"error": f"Could not process file (or file is an image): {path}"})
             sys.exit(1)
+
+        # The first file decides whether this is a video or an audio-only append
+        if i == 0:
+            is_video_concat = info['has_video']
+            is_audio_concat = info['has_audio'] and not is_video_concat
         
         # Enforce consistency
         if is_video_concat and not info['has_video']:
-            print(json.dumps({"error": "Cannot mix video and audio-only files in a video append."}))
+            write_json({"error": "Cannot mix video and audio-only files in a video append."})
             sys.exit(1)
         if is_audio_concat and not info['has_audio']:
-             print(json.dumps({"error": "Cannot mix audio and video files in an audio-only append."}))
+             write_json({"error": "Cannot mix audio and video files in an audio-only append."})
              sys.exit(1)
 
         inputs.extend(['-i', path])
+        paths.append(path)
+        infos.append(info)
         if is_video_concat:
             filter_complex_parts.append(f"[{i}:v:0]")
         if info['has_audio']:
@@ -102,44 +172,88 @@ def main():
     # --- 3. Determine Output Path and Execute ---
     output_as_file_path = params.get('outputAsFilePath', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
+    concat_list_path = None
     
     try:
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
+            ext = os.path.splitext(output_path)[1]
         else:
-            temp_dir = tempfile.gettempdir()
             ext = ".mp4" if is_video_concat else ".mp3"
-            output_path = os.path.join(temp_dir, f"ffmpeg_append_output{ext}")
+            file_name = f"ffmpeg_append_output{ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped, skipping the temp file.
+                pipe_muxer = PIPE_MUXERS.get(ext)
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
 
-        command = ['ffmpeg', '-y'] + inputs
-        command.extend(['-filter_complex', filter_complex])
-        if is_video_concat:
-            command.extend(['-map', '[outv]'])
-        command.extend(['-map', '[outa]'])
+        if can_concat_demux(paths, infos, ext):
+            # Uniform inputs can be joined by copying packets, with no decode or re-encode
+            concat_list_path = write_concat_list(paths)
+            command = [FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_list_path, '-c', 'copy']
+        else:
+            command = [FFMPEG, '-y'] + inputs
+            command.extend(['-filter_complex', filter_complex])
+            if is_video_concat:
+                command.extend(['-map', '[outv]'])
+            command.extend(['-map', '[outa]'])
+
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
         command.append(output_path)
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
+        if concat_list_path:
+            try:
+                os.remove(concat_list_path)
+            except OSError as e:
+                sys.stderr.write(f"Error cleaning up concat list {concat_list_path}: {e}\n")
         if not output_as_file_path and output_path and os.path.exists(output_path):
             try:
                 os.remove(output_path)
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
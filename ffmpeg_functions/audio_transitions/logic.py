@@ -1,48 +1,13 @@
 import sys
-import json
 import subprocess
 import tempfile
 import os
-import base64
 
-def get_media_duration(file_path):
-    """Get the duration of a media file using ffprobe."""
-    command = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1', file_path
-    ]
-    try:
-        is_windows = sys.platform == "win32"
-        result = subprocess.run(command, capture_output=True, text=True, check=True, shell=is_windows)
-        return float(result.stdout.strip())
-    except (subprocess.CalledProcessError, ValueError) as e:
-        sys.stderr.write(f"Error getting duration for {file_path}: {e}\n")
-        return None
-
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
-
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, load_params, write_json, get_file_path, run_ffmpeg, PIPE_MUXERS, make_handoff_path, probe_duration, stream_ffmpeg_output, write_binary_output
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         transition_type = params.get('transitionType', 'fadeIn')
@@ -51,12 +16,12 @@ def main():
         if not os.path.exists(input_path):
             raise ValueError(f"Input file not found at path: {input_path}")
 
-        audio_duration = get_media_duration(input_path)
+        audio_duration = probe_duration(input_path)
         if audio_duration is None:
             raise ValueError("Could not determine the duration of the input audio file.")
 
     except (ValueError, TypeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     # --- Build Filter Complex ---
@@ -78,38 +43,54 @@ def main():
     # --- Determine Output Path and Execute ---
     output_as_file_path = params.get('outputAsFilePath', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     
     try:
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
             # Use the original extension if possible, otherwise default to mp3
             _, ext = os.path.splitext(input_path)
             if not ext: ext = ".mp3"
-            output_path = os.path.join(temp_dir, f"ffmpeg_fade_output{ext}")
+            file_name = f"ffmpeg_fade_output{ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped, skipping the temp file.
+                pipe_muxer = PIPE_MUXERS.get(ext.lower())
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
 
         command = [
-            'ffmpeg', '-y', '-i', input_path,
+            FFMPEG, '-y', '-i', input_path,
             '-af', filter_complex,
-            output_path
         ]
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        command.append(output_path)
+
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
         if not output_as_file_path and output_path and os.path.exists(output_path):
@@ -118,5 +99,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
@@ -1,41 +1,66 @@
 import sys
-import json
 import os
+import hashlib
+import tempfile
 import librosa
 import numpy as np
+from scipy.ndimage import uniform_filter1d
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import load_params, write_json, get_file_path
+
+# Onset analysis settings. Beats are sampled at a few per second, so a coarser
+# hop and fewer mel bands than librosa's defaults (512 / 128) lose nothing.
+ONSET_HOP_LENGTH = 1024
+ONSET_N_FFT = 2048
+ONSET_N_MELS = 64
+
+def onset_cache_path(input_path):
+    """Returns the cache file for an input's onset envelope, keyed on its identity and the onset settings."""
+    st = os.stat(input_path)
+    key_source = f"{os.path.abspath(input_path)}|{st.st_mtime_ns}|{st.st_size}|{ONSET_HOP_LENGTH}|{ONSET_N_FFT}|{ONSET_N_MELS}"
+    key = hashlib.blake2b(key_source.encode('utf-8'), digest_size=8).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f"yak_onset_{key}.npz")
+
+def load_onset_envelope(input_path):
+    """
+    Decodes the audio and computes its onset strength envelope, reusing a
+    cached result when the same unchanged file was analysed before.
+    """
+    cache_path = onset_cache_path(input_path)
+    try:
+        with np.load(cache_path) as cached:
+            return cached['onset_env'], int(cached['sr'])
+    except Exception:
+        pass # Missing or unreadable cache entry; compute it below
+
+    # Keep the native sample rate; onset detection doesn't need the default 22.05 kHz resample.
+    y, sr = librosa.load(input_path, sr=None, mono=True)
+    # This gives us a measure of "energy" over time
+    onset_env = librosa.onset.onset_strength(
+        y=y, sr=sr, hop_length=ONSET_HOP_LENGTH, n_fft=ONSET_N_FFT, n_mels=ONSET_N_MELS
+    )
+
+    try:
+        # Write to a temp file and swap it in so concurrent runs never read a partial entry.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, onset_env=onset_env, sr=sr)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        sys.stderr.write(f"Could not write onset cache {cache_path}: {e}\n")
+
+    return onset_env, sr
 
 def moving_average(data, window_size):
     """Applies a simple moving average for smoothing."""
     if window_size <= 1:
         return data
-    # Pad the data to handle edges
-    padded_data = np.pad(data, (window_size//2, window_size-1-window_size//2), mode='edge')
-    return np.convolve(padded_data, np.ones(window_size)/window_size, mode='valid')
-
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+    # Running-sum filter; 'nearest' repeats the edge values, matching edge padding.
+    return uniform_filter1d(np.asarray(data, dtype=np.float64), size=window_size, mode='nearest')
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         beats_per_second = int(params.get('beatsPerSecond', 2))
@@ -45,20 +70,16 @@ def main():
             raise ValueError(f"Input file not found at path: {input_path}")
 
     except (ValueError, TypeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     try:
-        # --- 1. Load Audio File ---
-        y, sr = librosa.load(input_path)
-
-        # --- 2. Get Onset Strength ---
-        # This gives us a measure of "energy" over time
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
+        # --- 1. Load Audio and Get Onset Strength ---
+        onset_env, sr = load_onset_envelope(input_path)
         
-        # --- 3. Sample the Strength at Regular Intervals ---
+        # --- 2. Sample the Strength at Regular Intervals ---
         # Calculate how many frames correspond to the desired beats per second
-        hop_length = 512 # Default hop_length for onset_strength
+        hop_length = ONSET_HOP_LENGTH
         frames_per_sample = int((sr / hop_length) / beats_per_second)
         
         if frames_per_sample == 0:
@@ -66,7 +87,7 @@ def main():
 
         sampled_strengths = onset_env[::frames_per_sample]
         
-        # --- 4. Normalize and Smooth ---
+        # --- 3. Normalize and Smooth ---
         # Normalize strength to a 0-100 scale
         if np.max(sampled_strengths) > 0:
             normalized_strengths = (sampled_strengths / np.max(sampled_strengths)) * 100
@@ -80,23 +101,36 @@ def main():
         
         smoothed_strengths = moving_average(normalized_strengths, window_size)
 
-        # --- 5. Create Timestamped Output ---
-        beat_data = []
+        # --- 4. Create Timestamped Output ---
         duration_per_sample = frames_per_sample * (hop_length / sr)
-        
-        for i, strength in enumerate(smoothed_strengths):
-            timestamp = i * duration_per_sample
-            beat_data.append({
-                "timestamp": round(timestamp, 4),
-                "strength": int(round(strength))
-            })
+        timestamps = np.round(np.arange(len(smoothed_strengths)) * duration_per_sample, 4)
+        strengths = np.rint(smoothed_strengths).astype(np.int64)
+        beat_data = [
+            {"timestamp": timestamp, "strength": strength}
+            for timestamp, strength in zip(timestamps.tolist(), strengths.tolist())
+        ]
             
-        print(json.dumps(beat_data))
+        return beat_data
+
+    except Exception as e:
+        write_json({"error": f"An error occurred during beat detection: {str(e)}"})
+        sys.exit(1)
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
     except Exception as e:
-        print(json.dumps({"error": f"An error occurred during beat detection: {str(e)}"}))
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
         sys.exit(1)
 
+    result = run(params)
+    if result is not None:
+        write_json(result)
 
 if __name__ == '__main__':
     main()
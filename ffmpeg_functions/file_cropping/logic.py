@@ -1,34 +1,13 @@
 import sys
-import json
 import subprocess
 import tempfile
 import os
-import base64
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
-
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, H264_CONTAINERS, load_params, write_json, get_file_path, run_ffmpeg, PIPE_MUXERS, SOFTWARE_H264_ARGS, get_h264_codec_args, make_handoff_path, stream_ffmpeg_output, write_binary_output
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         width = int(params.get('cropWidth', 1920))
@@ -40,7 +19,7 @@ def main():
             raise ValueError(f"Input file not found at path: {input_path}")
 
     except (ValueError, TypeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     # --- Build Filter ---
@@ -50,38 +29,63 @@ def main():
     # --- Determine Output Path and Execute ---
     output_as_file_path = params.get('outputAsFilePath', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     
     try:
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
             _, ext = os.path.splitext(input_path)
             if not ext: ext = ".mp4" # Default extension
-            output_path = os.path.join(temp_dir, f"ffmpeg_crop_output{ext}")
+            file_name = f"ffmpeg_crop_output{ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped, skipping the temp file.
+                pipe_muxer = PIPE_MUXERS.get(ext.lower())
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
 
-        command = [
-            'ffmpeg', '-y', '-i', input_path,
+        output_ext = os.path.splitext(output_path if output_path else file_name)[1].lower()
+        video_codec_args = get_h264_codec_args(params.get('hwaccel', 'auto')) if output_ext in H264_CONTAINERS else []
+
+        command = [FFMPEG, '-y']
+        if video_codec_args and video_codec_args is not SOFTWARE_H264_ARGS:
+            command.extend(['-hwaccel', 'auto']) # Decode on the GPU when the encoder runs there too
+        command.extend([
+            '-i', input_path,
+            '-map', '0:v:0', '-map', '0:a?', # Only the video and any audio; other streams are never read
             '-vf', crop_filter, # Use -vf for video filter
+        ] + video_codec_args + [
+            '-threads', '0', # Let the encoder use every core
             '-c:a', 'copy', # Copy the audio stream without re-encoding
-            output_path
-        ]
+        ])
+
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        command.append(output_path)
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
         if not output_as_file_path and output_path and os.path.exists(output_path):
@@ -90,5 +94,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
@@ -1,54 +1,55 @@
 import sys
-import json
 import subprocess
 import tempfile
 import os
-import base64
 
-def get_media_duration(file_path):
-    """Get the duration of a media file using ffprobe."""
-    command = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1', file_path
-    ]
-    try:
-        is_windows = sys.platform == "win32"
-        result = subprocess.run(command, capture_output=True, text=True, check=True, shell=is_windows)
-        return float(result.stdout.strip())
-    except (subprocess.CalledProcessError, ValueError) as e:
-        sys.stderr.write(f"Error getting duration for {file_path}: {e}\n")
-        return None
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, FFPROBE, run_command, load_params, write_json, get_file_path, run_ffmpeg, PIPE_MUXERS, make_handoff_path, stream_ffmpeg_output, write_binary_output
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
+# Durations already probed in this process, keyed by (path, mtime, size) so an edited file is re-probed
+_duration_cache = {}
 
-def run_ffmpeg_command(command):
-    """Runs an FFmpeg command and handles errors."""
-    is_windows = sys.platform == "win32"
-    subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+def get_media_duration(file_path):
+    """Get the duration of a media file using ffprobe, probing each unchanged file only once."""
+    st = os.stat(file_path)
+    key = (file_path, st.st_mtime_ns, st.st_size)
+    if key in _duration_cache:
+        return _duration_cache[key]
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+    duration = None
+    # The container header usually carries the duration, so try a capped probe first and only
+    # let ffprobe analyse the streams in full when that comes back empty.
+    for probe_limits in (['-analyzeduration', '100000', '-probesize', '500000'], []):
+        command = [FFPROBE, '-v', 'error'] + probe_limits + [
+            '-show_entries', 'format=duration', '-of', 'csv=p=0', file_path
+        ]
+        try:
+            result = run_command(command)
+            duration = float(result.stdout.strip())
+            break
+        except (subprocess.CalledProcessError, ValueError) as e:
+            error = e
+    if duration is None:
+        sys.stderr.write(f"Error getting duration for {file_path}: {error}\n")
+        return None
+    _duration_cache[key] = duration
+    return duration
+
+def segment_output_args(input_index, destination):
+    """Returns the output arguments that stream-copy one input's video, audio and (for .mkv) subtitles to a destination."""
+    # The main video plus every audio track, so trimming drops none of them
+    args = ['-map', f'{input_index}:v:0?', '-map', f'{input_index}:a?']
+    if os.path.splitext(destination[-1])[1].lower() == '.mkv':
+        # Matroska takes any subtitle codec; MP4/MOV would reject most of them and fail the whole trim
+        args.extend(['-map', f'{input_index}:s?'])
+    args.extend(['-c', 'copy']) # Use stream copy for speed, as no re-encoding is needed
+    return args + destination
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     output_as_file_path = True # Default
     keep_segments = params.get('keepTrimmedSegments', False)
     
@@ -61,82 +62,99 @@ def main():
     try:
         input_path = get_file_path(params, 'input')
         start_time = float(params.get('startTime', 0))
-        end_time = float(params.get('endTime', 10))
+        end_time = params.get('endTime', 10)
+        # An empty end time trims through to the end of the media
+        end_time = None if end_time in (None, '') else float(end_time)
         
         if not os.path.exists(input_path):
             raise ValueError(f"Input file not found at path: {input_path}")
 
-        duration = get_media_duration(input_path)
-        if duration is None:
-            raise ValueError("Could not determine the duration of the input file.")
-        if start_time >= end_time or start_time > duration:
-            raise ValueError("Start time must be less than end time and within the media's duration.")
+        if end_time is not None and start_time >= end_time:
+            raise ValueError("Start time must be less than end time.")
+
+        # The duration is only needed to know whether anything is left after the trim.
+        # A start past the end is not checked here; FFmpeg just writes an empty segment.
+        duration = None
+        if keep_segments and end_time is not None:
+            duration = get_media_duration(input_path)
+            if duration is None:
+                raise ValueError("Could not determine the duration of the input file.")
 
         # --- Determine Output Path ---
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
             _, ext = os.path.splitext(input_path)
             if not ext: ext = ".mp4"
-            output_path = os.path.join(temp_dir, f"ffmpeg_trim_output{ext}")
-
-        # --- 1. Create Main Trimmed Segment ---
-        main_command = [
-            'ffmpeg', '-y', '-i', input_path,
-            '-ss', str(start_time),
-            '-to', str(end_time),
-            '-c', 'copy', # Use stream copy for speed, as no re-encoding is needed
-            output_path
-        ]
-        run_ffmpeg_command(main_command)
+            file_name = f"ffmpeg_trim_output{ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped, skipping the temp file.
+                pipe_muxer = PIPE_MUXERS.get(ext.lower())
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
 
+        # --- Build a Single Command for All Segments ---
+        # One FFmpeg run writes every segment. Each segment opens the input with its own
+        # input-side -ss, so the demuxer seeks straight to the nearest keyframe instead of
+        # reading everything before the cut; with stream copy the cut lands on a keyframe anyway.
         json_response = {}
 
-        # --- 2. Create "Before" and "After" Segments if Requested ---
+        # 1. Main trimmed segment
+        inputs = ['-ss', str(start_time)]
+        if end_time is not None:
+            inputs.extend(['-t', str(end_time - start_time)]) # -to would count from the seek point
+        inputs.extend(['-i', input_path])
+        if pipe_muxer:
+            # Segments are only kept when writing to a file path, so this is the only output.
+            command = [FFMPEG, '-y'] + inputs + segment_output_args(0, pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        outputs = segment_output_args(0, [output_path])
+        input_count = 1
+
+        # 2. "Before" and "After" segments if requested
         if keep_segments:
             path_parts = os.path.splitext(output_path)
             
             # Create "before" segment if start_time > 0
             if start_time > 0:
                 before_path = f"{path_parts[0]}_before{path_parts[1]}"
-                before_command = [
-                    'ffmpeg', '-y', '-i', input_path,
-                    '-to', str(start_time),
-                    '-c', 'copy',
-                    before_path
-                ]
-                run_ffmpeg_command(before_command)
+                inputs.extend(['-t', str(start_time), '-i', input_path])
+                outputs.extend(segment_output_args(input_count, [before_path]))
+                input_count += 1
                 json_response['before_segment_path'] = before_path
 
             # Create "after" segment if end_time < duration
-            if end_time < duration:
+            if end_time is not None and end_time < duration:
                 after_path = f"{path_parts[0]}_after{path_parts[1]}"
-                after_command = [
-                    'ffmpeg', '-y', '-i', input_path,
-                    '-ss', str(end_time),
-                    '-c', 'copy',
-                    after_path
-                ]
-                run_ffmpeg_command(after_command)
+                inputs.extend(['-ss', str(end_time), '-i', input_path])
+                outputs.extend(segment_output_args(input_count, [after_path]))
+                input_count += 1
                 json_response['after_segment_path'] = after_path
 
+        command = [FFMPEG, '-y'] + inputs + outputs
+        run_ffmpeg(command)
+
         # --- Handle Final Output ---
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            json_response['binary_data'] = encoded_data
-            json_response['file_name'] = os.path.basename(output_path)
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
             json_response['output_path'] = output_path
-        
-        print(json.dumps(json_response))
+            return json_response
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message}))
+        write_json({"error": error_message})
         sys.exit(1)
     finally:
         # Clean up the primary temp file if binary output was used
@@ -146,5 +164,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,193 @@
+import sys
+import json
+import subprocess
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, load_params, write_json, get_file_path, run_ffmpeg, CROP_POSITIONS, PAD_POSITIONS, PIPE_MUXERS, make_handoff_path, stream_ffmpeg_output
+
+def build_trim(op):
+    """Returns input-side seek arguments for a trim step."""
+    start = float(op.get('start', 0))
+    end = op.get('end')
+    args = ['-ss', str(start)]
+    if end not in (None, ''):
+        end = float(end)
+        if start >= end:
+            raise ValueError("Trim start must be less than trim end.")
+        args.extend(['-t', str(end - start)])
+    return args
+
+def build_crop(op):
+    """Returns the video filters for a crop step."""
+    width, height = int(op['width']), int(op['height'])
+    x, y = int(op.get('x', 0)), int(op.get('y', 0))
+    return [f"crop={width}:{height}:{x}:{y}"], []
+
+def build_resize(op):
+    """Returns the video filters for a resize step, using the same methods as Resize Files."""
+    out_w, out_h = int(op.get('width', 1920)), int(op.get('height', 1080))
+    method = op.get('method', 'stretch')
+    anchor = str(op.get('anchor', 'center')).lower().replace(' ', '')
+
+    if method == 'stretch':
+        return [f"scale={out_w}:{out_h}"], []
+    if method == 'crop':
+        x, y = CROP_POSITIONS.get(anchor, CROP_POSITIONS['center'])
+        return [
+            f"scale={out_w}:{out_h}:force_original_aspect_ratio=increase",
+            "setsar=1",
+            f"crop={out_w}:{out_h}:{x}:{y}",
+        ], []
+    if method == 'pad':
+        color = op.get('color', 'black')
+        if color == 'transparent':
+            raise ValueError("Transparent padding is not supported in a pipeline; the output is H.264.")
+        x, y = PAD_POSITIONS.get(anchor, PAD_POSITIONS['center'])
+        return [
+            f"scale={out_w}:{out_h}:force_original_aspect_ratio=decrease",
+            f"pad={out_w}:{out_h}:{x}:{y}:color={color}",
+        ], []
+    raise ValueError(f"Unknown resize method: {method}")
+
+def build_normalize(op):
+    """Returns the video and audio filters for a normalize step, using the same settings as Normalize Files."""
+    video_filters, audio_filters = [], []
+    resolution = op.get('resolution', 'original')
+    aspect_ratio = op.get('aspectRatio', 'original')
+    frame_rate = op.get('frameRate', 'original')
+    loudness = op.get('loudness')
+
+    if resolution != 'original':
+        video_filters.append(f"scale={resolution}")
+    if aspect_ratio != 'original':
+        video_filters.append(f"setdar={aspect_ratio.replace(':', '/')}")
+    video_filters.append("setsar=1")
+    if frame_rate != 'original':
+        video_filters.append(f"fps={frame_rate}")
+    if loudness not in (None, ''):
+        audio_filters.append(f"loudnorm=I={loudness}:LRA=7:tp=-2")
+    return video_filters, audio_filters
+
+FILTER_BUILDERS = {
+    'crop': build_crop,
+    'resize': build_resize,
+    'normalize': build_normalize,
+}
+
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
+    # --- 1. Parse the Pipeline ---
+    # Every step becomes part of one FFmpeg run, so the input is decoded once
+    # instead of once per chained node.
+    try:
+        input_path = get_file_path(params, 'input')
+        if not os.path.exists(input_path):
+            raise ValueError(f"Input file not found at path: {input_path}")
+
+        pipeline = params.get('pipeline')
+        if pipeline is None:
+            pipeline_str = params.get('pipelineJson')
+            if not pipeline_str:
+                raise ValueError("The 'Pipeline (JSON Array)' parameter is required.")
+            pipeline = json.loads(pipeline_str)
+        if not isinstance(pipeline, list) or not pipeline:
+            raise ValueError("The pipeline must be a JSON array with at least one step.")
+
+        input_args = []
+        video_filters, audio_filters = [], []
+        for i, op in enumerate(pipeline):
+            name = op.get('op') if isinstance(op, dict) else None
+            if name == 'trim':
+                if input_args:
+                    raise ValueError("A pipeline can contain only one trim step.")
+                # Seeking on the input skips demuxing and decoding everything before the start.
+                input_args = build_trim(op)
+            elif name in FILTER_BUILDERS:
+                step_video, step_audio = FILTER_BUILDERS[name](op)
+                video_filters.extend(step_video)
+                audio_filters.extend(step_audio)
+            else:
+                raise ValueError(f"Step {i} has an unknown op: {name}. Use trim, crop, resize or normalize.")
+
+    except (ValueError, TypeError, KeyError, json.JSONDecodeError) as e:
+        write_json({"error": str(e)})
+        sys.exit(1)
+
+    # --- 2. Build the Filter Graph ---
+    video_chain = ",".join(video_filters) if video_filters else "null"
+    filter_complex = f"[0:v:0]{video_chain}[vout]"
+
+    # --- 3. Determine Output Path and Execute ---
+    output_as_file_path = params.get('outputAsFilePath', True)
+    output_path = None
+    pipe_muxer = None
+    hand_off = False
+    
+    try:
+        if output_as_file_path:
+            output_path = params.get('outputFilePath')
+            if not output_path: raise ValueError("Output file path is required.")
+        else:
+            file_name = "ffmpeg_pipeline_output.mp4"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # A fragmented MP4 can be written to a pipe, so stream straight from FFmpeg.
+                pipe_muxer = PIPE_MUXERS['.mp4']
+
+        command = [FFMPEG, '-y'] + input_args + ['-i', input_path]
+        command.extend(['-filter_complex', filter_complex, '-map', '[vout]', '-map', '0:a:0?'])
+        if audio_filters:
+            command.extend(['-af', ",".join(audio_filters), '-ar', '48000'])
+        command.extend([
+            '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+            '-threads', '0', # Let the encoder use every core
+            '-c:a', 'aac',
+        ])
+
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        command.append(output_path)
+
+        run_ffmpeg(command)
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        return {"output_path": output_path}
+
+    except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
+        error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
+        sys.exit(1)
+    finally:
+        # Only a failed handoff leaves a file behind; a successful one belongs to the node
+        if hand_off and output_path and os.path.exists(output_path):
+            try:
+                os.remove(output_path)
+            except OSError as e:
+                sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
+
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,23 @@
 import sys
-import json
 import subprocess
-import tempfile
 import os
-import base64
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
-
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, load_params, write_json, get_file_path, run_ffmpeg, PIPE_MUXERS, make_handoff_path, stream_ffmpeg_output, write_binary_output
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         similarity = float(params.get('similarity', 0.1))
         blend = float(params.get('blend', 0.1))
+        keep_audio = params.get('keepAudio', True)
         
         if not os.path.exists(input_path):
             raise ValueError(f"Input file not found at path: {input_path}")
 
     except (ValueError, TypeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     # --- Build Filter ---
@@ -50,41 +29,67 @@ def main():
     # --- Determine Output Path and Execute ---
     output_as_file_path = params.get('outputAsFilePath', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     
     try:
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
             # To support transparency, we should default to a capable container like .mov
-            output_path = os.path.join(temp_dir, "ffmpeg_greenscreen_output.mov")
+            file_name = "ffmpeg_greenscreen_output.mov"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # A fragmented .mov can be written to a pipe, so stream straight from FFmpeg.
+                pipe_muxer = PIPE_MUXERS['.mov']
 
         # Command needs a codec that supports an alpha (transparency) channel.
         # prores_ks is a good choice for .mov containers.
-        command = [
-            'ffmpeg', '-y', '-i', input_path,
-            '-vf', chroma_filter,
-            '-c:v', 'prores_ks', # Codec that supports alpha channel
-            '-pix_fmt', 'yuva444p10le', # Pixel format for transparency
-            '-c:a', 'copy', # Copy audio without re-encoding
-            output_path
-        ]
+        if similarity <= 0.0:
+            # A zero similarity keys out nothing, so copy the streams instead of scanning every pixel
+            command = [FFMPEG, '-y', '-i', input_path, '-c', 'copy']
+        else:
+            command = [
+                FFMPEG, '-y', '-i', input_path,
+                '-vf', chroma_filter,
+                '-c:v', 'prores_ks', # Codec that supports alpha channel
+                '-pix_fmt', 'yuva444p10le', # Pixel format for transparency
+                '-threads', '0', # Let the encoder use every core
+            ]
+
+        if not keep_audio:
+            command.append('-an')
+        elif similarity > 0.0:
+            # .mov can't carry every source codec (e.g. Opus from WebM), but it always takes PCM,
+            # which also costs next to nothing to encode.
+            output_ext = '.mov' if pipe_muxer else os.path.splitext(output_path)[1].lower()
+            audio_codec = 'pcm_s16le' if output_ext == '.mov' else 'copy'
+            command.extend(['-c:a', audio_codec, '-shortest'])
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        command.append(output_path)
+
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
         if not output_as_file_path and output_path and os.path.exists(output_path):
@@ -93,5 +98,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
@@ -1,34 +1,12 @@
 import sys
-import json
 import subprocess
-import tempfile
 import os
-import base64
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
-
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
-    try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, load_params, write_json, get_file_path, run_ffmpeg, PIPE_MUXERS, SOFTWARE_H264_ARGS, get_h264_codec_args, make_handoff_path, stream_ffmpeg_output, write_binary_output
 
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         duration = float(params.get('duration', 10))
@@ -39,46 +17,71 @@ def main():
             raise ValueError("Duration must be a positive number.")
 
     except (ValueError, TypeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     # --- Determine Output Path and Execute ---
     output_as_file_path = params.get('outputAsFilePath', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     
     try:
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
-            output_path = os.path.join(temp_dir, "ffmpeg_image_to_video_output.mp4")
+            file_name = "ffmpeg_image_to_video_output.mp4"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # A fragmented MP4 can be written to a pipe, so stream straight from FFmpeg.
+                pipe_muxer = PIPE_MUXERS['.mp4']
 
-        # Command to loop an image for a specific duration to create a video
+        # Command to loop an image for a specific duration to create a video.
+        # The codec args pick H.264 (libx264 or a hardware encoder) with a widely compatible pixel format.
+        video_codec_args = get_h264_codec_args(params.get('hwaccel'))
         command = [
-            'ffmpeg', '-y', 
+            FFMPEG, '-y', 
             '-loop', '1',          # Loop the input image
+            '-framerate', '1',     # Read it once a second; the output rate duplicates frames for free
             '-i', input_path,
-            '-c:v', 'libx264',      # A standard, widely compatible video codec
+        ] + video_codec_args
+        if video_codec_args is SOFTWARE_H264_ARGS:
+            # The frames are identical, so x264 can spend almost no bits or time on them.
+            # B-frames buy nothing on a static picture and a long GOP avoids needless keyframes.
+            command.extend(['-preset', params.get('x264Preset') or 'veryfast', '-g', '250', '-bf', '0'])
+            x264_tune = params.get('x264Tune', 'stillimage')
+            if x264_tune and x264_tune != 'none':
+                command.extend(['-tune', x264_tune])
+        command.extend([
             '-t', str(duration),    # Set the total duration of the video
-            '-pix_fmt', 'yuv420p',  # Pixel format for maximum compatibility
-            output_path
-        ]
+            '-r', '25',             # Output frame rate
+            '-threads', '0',        # Let the encoder use every core
+        ])
+
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        command.append(output_path)
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
         if not output_as_file_path and output_path and os.path.exists(output_path):
@@ -87,5 +90,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
@@ -4,31 +4,43 @@ import subprocess
 import tempfile
 import os
 import shutil
+import errno
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, FFPROBE, run_command, load_params, write_json, get_file_path, run_ffmpeg
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+def move_file(src, dst):
+    """Moves a file, renaming it in place when possible and copying it across filesystems otherwise."""
     try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
 
+    # The temp dir is often on a different filesystem than the user's files
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            # Let the kernel copy the data without it passing through Python
+            size = os.fstat(fsrc.fileno()).st_size
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        shutil.copyfileobj(fsrc, fdst, length=COPY_BUFFER_SIZE)
+    os.unlink(src)
+
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         mode = params.get('mode', 'show')
         input_path = get_file_path(params, 'input')
@@ -39,14 +51,12 @@ def main():
         # --- MODE: Show Metadata ---
         if mode == 'show':
             command = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json',
+                FFPROBE, '-v', 'quiet', '-print_format', 'json',
                 '-show_format', '-show_streams', input_path
             ]
-            is_windows = sys.platform == "win32"
-            result = subprocess.run(command, capture_output=True, text=True, check=True, shell=is_windows)
+            result = run_command(command)
             metadata = json.loads(result.stdout)
-            print(json.dumps(metadata))
-            sys.exit(0)
+            return metadata
 
         # --- MODE: Edit Metadata ---
         elif mode == 'edit':
@@ -82,23 +92,38 @@ def main():
             
             # FFmpeg command to copy streams and add metadata
             command = [
-                'ffmpeg', '-y', '-i', input_path,
+                FFMPEG, '-y', '-i', input_path,
                 '-c', 'copy', # Copy all streams without re-encoding
             ] + metadata_args + [temp_output_path]
 
-            is_windows = sys.platform == "win32"
-            subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+            run_ffmpeg(command)
             
             # If replacing, perform the safe move/delete operation
             if replace_original:
-                shutil.move(temp_output_path, output_path)
+                move_file(temp_output_path, output_path)
 
-            print(json.dumps({"status": "Metadata edited successfully.", "output_path": output_path}))
+            return {"status": "Metadata edited successfully.", "output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"Operation failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message}))
+        write_json({"error": error_message})
         sys.exit(1)
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
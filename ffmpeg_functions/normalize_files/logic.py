@@ -3,32 +3,48 @@ import json
 import subprocess
 import tempfile
 import os
-import base64
-
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
+import functools
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, FFPROBE, run_command, load_params, write_json, get_file_path, run_ffmpeg, PIPE_MUXERS, SOFTWARE_H264_ARGS, get_h264_codec_args, make_handoff_path, stream_ffmpeg_output, write_binary_output
+
+# Colour space tags that already mean sRGB, or that leave it unspecified (and so are treated as sRGB)
+SRGB_COLOR_SPACES = {None, 'unknown', 'gbr', 'bt709', 'iec61966-2-1'}
+
+def get_color_space(file_path):
+    """Returns the colour space tag of the first video stream, or None if it has none."""
+    command = [
+        FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=color_space', '-of', 'json', file_path
+    ]
     try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+        result = run_command(command)
+        streams = json.loads(result.stdout).get('streams', [])
+        return streams[0].get('color_space') if streams else None
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        sys.stderr.write(f"Error probing colour space for {file_path}: {e}\n")
+        return None
+
+@functools.lru_cache(maxsize=128)
+def build_video_filter(resolution, aspect_ratio):
+    """Builds the video normalization filter chain; cached because a batch usually repeats the same settings."""
+    video_filters = []
+    if resolution != 'original':
+        video_filters.append(f"scale={resolution}")
+    if aspect_ratio != 'original':
+        video_filters.append(f"setdar={aspect_ratio.replace(':', '/')}")
+
+    # Default SAR normalization
+    video_filters.append("setsar=1")
+    return ",".join(video_filters)
 
+@functools.lru_cache(maxsize=128)
+def build_audio_filter(loudness):
+    """Builds the EBU R128 loudness normalization filter."""
+    return f"loudnorm=I={loudness}:LRA=7:tp=-2"
+
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         media_type = params.get('mediaType', 'video')
@@ -36,42 +52,36 @@ def main():
         if not os.path.exists(input_path):
             raise ValueError(f"Input file not found at path: {input_path}")
 
-        command = ['ffmpeg', '-y', '-i', input_path]
+        # Only the video branch encodes H.264, so only it can move to a hardware encoder
+        video_codec_args = get_h264_codec_args(params.get('hwaccel')) if media_type == 'video' else SOFTWARE_H264_ARGS
+
+        command = [FFMPEG, '-y']
+        if video_codec_args is not SOFTWARE_H264_ARGS:
+            command.extend(['-hwaccel', 'auto']) # Decode on the GPU when the encoder runs there too
+        command.extend(['-i', input_path])
         output_ext = ""
 
         # --- VIDEO NORMALIZATION ---
         if media_type == 'video':
-            video_filters = []
             resolution = params.get('videoResolution', 'original')
             aspect_ratio = params.get('videoAspectRatio', 'original')
             frame_rate = params.get('videoFrameRate', 'original')
             output_ext = params.get('videoFormat', 'mp4')
 
-            if resolution != 'original':
-                video_filters.append(f"scale={resolution}")
-            if aspect_ratio != 'original':
-                video_filters.append(f"setdar={aspect_ratio.replace(':', '/')}")
-            
-            # Default SAR normalization
-            video_filters.append("setsar=1")
-
-            if video_filters:
-                command.extend(['-vf', ",".join(video_filters)])
+            command.extend(['-vf', build_video_filter(resolution, aspect_ratio)])
             
             if frame_rate != 'original':
                 command.extend(['-r', frame_rate])
 
             # Default normalizations
-            command.extend(['-c:v', 'libx24', '-pix_fmt', 'yuv420p', '-c:a', 'aac'])
+            command.extend(video_codec_args + ['-c:a', 'aac'])
 
         # --- AUDIO NORMALIZATION ---
         elif media_type == 'audio':
             loudness = params.get('audioLoudness', '-14')
             output_ext = params.get('audioFormat', 'mp3')
             
-            # EBU R128 loudness normalization filter
-            audio_filter = f"loudnorm=I={loudness}:LRA=7:tp=-2"
-            command.extend(['-af', audio_filter])
+            command.extend(['-af', build_audio_filter(loudness)])
             
             # Default normalizations
             command.extend(['-ar', '48000'])
@@ -81,41 +91,61 @@ def main():
             output_ext = params.get('imageFormat', 'png')
             quality = params.get('imageQuality', 92)
             
-            # Default sRGB conversion
-            command.extend(['-vf', 'colorspace=all=srgb:iall=srgb:fast=1'])
+            # sRGB conversion, skipped when the image is already sRGB so the pixels aren't rescanned for nothing
+            if get_color_space(input_path) not in SRGB_COLOR_SPACES:
+                command.extend(['-vf', 'colorspace=all=srgb:iall=srgb:fast=1'])
 
             if output_ext in ['jpg', 'jpeg']:
+                command.extend(['-c:v', 'mjpeg'])
                 command.extend(['-q:v', str(int(31 * (100 - quality) / 99))]) # Convert 1-100 scale to ffmpeg's 2-31 scale
             elif output_ext == 'webp':
+                command.extend(['-c:v', 'libwebp', '-preset', 'picture'])
                 command.extend(['-quality', str(quality)])
 
+        command.extend(['-threads', '0']) # Let the encoder use every core
+
         # --- Determine Output Path and Execute ---
         output_as_file_path = params.get('outputAsFilePath', True)
         output_path = None
+        pipe_muxer = None
+        hand_off = False
         
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
-            output_path = os.path.join(temp_dir, f"ffmpeg_normalized_output.{output_ext}")
-        
+            file_name = f"ffmpeg_normalized_output.{output_ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped; images and WAV still go via a temp file.
+                pipe_muxer = PIPE_MUXERS.get(f".{output_ext}")
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
+
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
         command.append(output_path)
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
         if 'output_path' in locals() and not output_as_file_path and output_path and os.path.exists(output_path):
@@ -124,5 +154,21 @@ def main():
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
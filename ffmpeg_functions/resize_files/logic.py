@@ -1,33 +1,63 @@
 import sys
-import json
 import subprocess
 import tempfile
 import os
-import base64
-
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
+import functools
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, FFPROBE, run_command, load_params, write_json, get_file_path, run_ffmpeg, H264_CONTAINERS, CROP_POSITIONS, PAD_POSITIONS, PIPE_MUXERS, SOFTWARE_H264_ARGS, get_h264_codec_args, make_handoff_path, stream_ffmpeg_output, write_binary_output
+
+@functools.lru_cache(maxsize=256)
+def cached_video_info(file_path, mtime_ns, size):
+    """Probes (width, height, codec_name) of a file's first video stream; memoised per unchanged file.
+
+    Failures raise and are therefore never memoised.
+    """
+    command = [
+        FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,codec_name', '-of', 'default=noprint_wrappers=1', file_path
+    ]
+    result = run_command(command)
+    fields = dict(line.partition('=')[::2] for line in result.stdout.splitlines())
+    return int(fields['width']), int(fields['height']), fields['codec_name']
+
+def get_video_info(file_path):
+    """Get the (width, height, codec_name) of a file's first video stream using ffprobe, probing each unchanged file only once."""
     try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+        st = os.stat(file_path)
+        return cached_video_info(file_path, st.st_mtime_ns, st.st_size)
+    except (subprocess.CalledProcessError, ValueError, KeyError, OSError) as e:
+        sys.stderr.write(f"Error probing video stream of {file_path}: {e}\n")
+        return None
+
+@functools.lru_cache(maxsize=128)
+def build_video_filter(method, out_w, out_h, anchor, color):
+    """Builds the resize filter chain; cached because a batch usually repeats the same settings."""
+    if method == 'stretch':
+        return f"scale={out_w}:{out_h}"
+
+    if method == 'crop':
+        # Scale to cover the area, then crop the excess.
+        # SAR=1 ensures pixels are square before calculations.
+        scale_filter = f"scale={out_w}:{out_h}:force_original_aspect_ratio=increase,setsar=1"
+        x, y = CROP_POSITIONS.get(anchor.lower().replace(' ', ''), CROP_POSITIONS['center'])
+        return f"{scale_filter},crop={out_w}:{out_h}:{x}:{y}"
+
+    if method == 'pad':
+        # Scale to fit inside the area, then pad the rest.
+        scale_filter = f"scale={out_w}:{out_h}:force_original_aspect_ratio=decrease"
+        x, y = PAD_POSITIONS.get(anchor.lower().replace(' ', ''), PAD_POSITIONS['center'])
+        return f"{scale_filter},pad={out_w}:{out_h}:{x}:{y}:color={color}"
+
+    return ""
+
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
+    # Set up front so the cleanup below can run even if validation fails
+    output_as_file_path = params.get('outputAsFilePath', True)
+    output_path = None
+    pipe_muxer = None
+    hand_off = False
 
     try:
         input_path = get_file_path(params, 'input')
@@ -38,93 +68,105 @@ def main():
         if not os.path.exists(input_path):
             raise ValueError(f"Input file not found at path: {input_path}")
 
-        video_filter = ""
-        # --- Build Filter Based on Method ---
-        if method == 'stretch':
-            video_filter = f"scale={out_w}:{out_h}"
-        
-        elif method == 'crop':
-            anchor = params.get('cropAnchor', 'center')
-            # Scale to cover the area, then crop the excess.
-            # SAR=1 ensures pixels are square before calculations.
-            scale_filter = f"scale='max({out_w}/iw,{out_h}/ih)*iw':'max({out_w}/iw,{out_h}/ih)*ih',setsar=1"
-            
-            x, y = '0', '0'
-            if 'left' in anchor.lower(): x = '0'
-            elif 'right' in anchor.lower(): x = '(iw-ow)'
-            else: x = '(iw-ow)/2' # Center
-            
-            if 'top' in anchor.lower(): y = '0'
-            elif 'bottom' in anchor.lower(): y = '(ih-oh)'
-            else: y = '(ih-oh)/2' # Center
-
-            crop_filter = f"crop={out_w}:{out_h}:{x}:{y}"
-            video_filter = f"{scale_filter},{crop_filter}"
-
-        elif method == 'pad':
-            anchor = params.get('placementAnchor', 'center')
-            color = params.get('padColor', 'black')
-            # Scale to fit inside the area, then pad the rest.
-            scale_filter = f"scale='min({out_w}/iw,{out_h}/ih)*iw':'min({out_w}/iw,{out_h}/ih)*ih'"
-            
-            x, y = '0', '0'
-            if 'left' in anchor.lower(): x = '0'
-            elif 'right' in anchor.lower(): x = f"({out_w}-iw)"
-            else: x = f"({out_w}-iw)/2" # Center
-            
-            if 'top' in anchor.lower(): y = '0'
-            elif 'bottom' in anchor.lower(): y = f"({out_h}-ih)"
-            else: y = f"({out_h}-ih)/2" # Center
-
-            pad_filter = f"pad={out_w}:{out_h}:{x}:{y}:color={color}"
-            video_filter = f"{scale_filter},{pad_filter}"
+        anchor = params.get('placementAnchor' if method == 'pad' else 'cropAnchor', 'center')
+        color = params.get('padColor', 'black')
+        video_filter = build_video_filter(method, out_w, out_h, anchor, color)
 
         # --- Determine Output Path and Execute ---
-        output_as_file_path = params.get('outputAsFilePath', True)
-        output_path = None
-        
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
             _, ext = os.path.splitext(input_path)
             # Default to a transparency-supporting format if needed
             if method == 'pad' and color == 'transparent': ext = ".mov"
             elif not ext: ext = ".mp4"
-            output_path = os.path.join(temp_dir, f"ffmpeg_resize_output{ext}")
+            file_name = f"ffmpeg_resize_output{ext}"
+            if params.get('binaryTransport', 'tempFile') == 'tempFile':
+                # The node runs on this host, so hand the file over by path instead of base64 on stdout.
+                output_path = make_handoff_path(file_name)
+                hand_off = True
+            else:
+                # Stream straight from FFmpeg when the container can be piped, skipping the temp file.
+                pipe_muxer = PIPE_MUXERS.get(ext.lower())
+                if not pipe_muxer:
+                    temp_dir = tempfile.gettempdir()
+                    output_path = os.path.join(temp_dir, file_name)
+
+        # Stretching to the size the input already has changes nothing, so skip the re-encode, but only
+        # when the source is already the H.264 a re-encode would produce and the container can hold it
+        output_ext = os.path.splitext(output_path if output_path else file_name)[1].lower()
+        stream_copy = (method == 'stretch' and output_ext in H264_CONTAINERS
+                       and get_video_info(input_path) == (out_w, out_h, 'h264'))
 
-        command = ['ffmpeg', '-y', '-i', input_path, '-vf', video_filter]
-        
         # Handle transparency
-        if method == 'pad' and color == 'transparent':
-            command.extend(['-c:v', 'prores_ks', '-pix_fmt', 'yuva444p10le'])
+        use_hardware = False
+        if stream_copy:
+            video_codec_args = ['-c:v', 'copy']
+        elif method == 'pad' and color == 'transparent':
+            video_codec_args = ['-c:v', 'prores_ks', '-pix_fmt', 'yuva444p10le']
         else:
-            command.extend(['-c:v', 'libx264', '-pix_fmt', 'yuv420p'])
+            video_codec_args = get_h264_codec_args(params.get('hwaccel'))
+            use_hardware = video_codec_args is not SOFTWARE_H264_ARGS
+            if not use_hardware:
+                # FFmpeg's default 'medium' preset is far slower than this pipeline needs
+                video_codec_args = video_codec_args + ['-preset', params.get('x264Preset') or 'veryfast']
+                x264_tune = params.get('x264Tune')
+                if x264_tune and x264_tune != 'none':
+                    video_codec_args += ['-tune', x264_tune]
 
-        command.extend(['-c:a', 'copy', output_path])
+        command = [FFMPEG, '-y']
+        if use_hardware:
+            command.extend(['-hwaccel', 'auto']) # Decode on the GPU when the encoder runs there too
+        command.extend(['-i', input_path])
+        if not stream_copy:
+            command.extend(['-vf', video_filter])
+        command.extend(video_codec_args)
+        command.extend(['-threads', '0', '-c:a', 'copy']) # Let the encoder use every core
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        if pipe_muxer:
+            command.extend(pipe_muxer + ['pipe:1'])
+            stream_ffmpeg_output(command, file_name)
+            return
+        command.append(output_path)
+
+        run_ffmpeg(command)
         
-        if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+        if hand_off:
+            result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+            output_path = None # The node owns the file now and deletes it once read
+            return result
+        elif not output_as_file_path:
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        write_json({"error": error_message, "command": " ".join(command if 'command' in locals() else [])})
         sys.exit(1)
     finally:
-        if not output_as_file_path and 'output_path' in locals() and output_path and os.path.exists(output_path):
+        if not output_as_file_path and output_path and os.path.exists(output_path):
             try:
                 os.remove(output_path)
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
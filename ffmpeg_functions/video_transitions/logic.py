@@ -3,121 +3,397 @@ import json
 import subprocess
 import tempfile
 import os
-import base64
+import hashlib
+import functools
+import shutil
 
-def get_media_duration(file_path):
-    """Get the duration of a media file using ffprobe."""
-    command = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1', file_path
-    ]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from _common import FFMPEG, FFPROBE, run_command, run_ffmpeg, load_params, write_json, get_file_path, PIPE_MUXERS, SOFTWARE_H264_ARGS, VAAPI_INPUT_ARGS, VAAPI_UPLOAD_FILTER, get_h264_codec_args, make_handoff_path, probe_media, stream_ffmpeg_output, write_binary_output
+
+# Durations persist across runs, keyed by a hash of the path and invalidated when the file's mtime or size changes.
+DURATION_CACHE_PATH = os.path.join(tempfile.gettempdir(), "yak_duration_cache.json")
+DURATION_CACHE_MAX_ENTRIES = 512
+
+def load_duration_cache():
+    """Loads the on-disk duration cache, treating a missing or corrupt file as empty."""
     try:
-        is_windows = sys.platform == "win32"
-        result = subprocess.run(command, capture_output=True, text=True, check=True, shell=is_windows)
-        return float(result.stdout.strip())
-    except (subprocess.CalledProcessError, ValueError) as e:
+        with open(DURATION_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_duration_cache(cache):
+    """Atomically writes the duration cache, dropping the oldest entries beyond the size cap."""
+    while len(cache) > DURATION_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(DURATION_CACHE_PATH), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, DURATION_CACHE_PATH)
+    except OSError as e:
+        sys.stderr.write(f"Could not write duration cache {DURATION_CACHE_PATH}: {e}\n")
+
+@functools.lru_cache(maxsize=1024)
+def cached_duration(file_path, mtime_ns, size):
+    """Returns a duration from the on-disk cache or a fresh probe.
+
+    Memoised per process, so a worker serving repeat jobs skips even the cache file read.
+    Failures raise and are therefore never memoised.
+    """
+    key = hashlib.sha1(file_path.encode('utf-8')).hexdigest()
+    cache = load_duration_cache()
+    entry = cache.get(key)
+    if entry and entry.get('mtime') == mtime_ns and entry.get('size') == size:
+        return entry['duration']
+
+    duration = float(probe_media(file_path).get('format', {}).get('duration', 0))
+    if not duration:
+        raise ValueError("the container doesn't report a duration")
+    cache.pop(key, None)
+    cache[key] = {'mtime': mtime_ns, 'size': size, 'duration': duration}
+    save_duration_cache(cache)
+    return duration
+
+def get_media_duration(file_path, st=None):
+    """Get the duration of a media file, probing it only when the cached value is missing or stale.
+
+    Reuses the caller's stat result when given.
+    """
+    try:
+        if st is None:
+            st = os.stat(file_path)
+        return cached_duration(file_path, st.st_mtime_ns, st.st_size)
+    except (subprocess.CalledProcessError, ValueError, OSError) as e:
         sys.stderr.write(f"Error getting duration for {file_path}: {e}\n")
         return None
 
-def get_file_path(params, base_name):
-    """Extracts the file path from the parameters."""
-    if params.get(f"{base_name}UseFilePath"):
-        path = params.get(f"{base_name}FilePath")
-        if not path: raise ValueError(f"File path for '{base_name}' is missing.")
-        return path
-    else:
-        path = params.get(f"{base_name}BinaryPropertyName")
-        if not path: raise ValueError(f"Binary property name for '{base_name}' is missing.")
-        return path
+# Outputs larger than this are handed to the node by path instead of being base64-encoded into stdout.
+MAX_INLINE_OUTPUT_BYTES = 32 * 1024 * 1024
 
-def main():
-    if len(sys.argv) != 2:
-        print(json.dumps({"error": "Expected a single argument: the path to the parameters JSON file."}))
-        sys.exit(1)
-    
-    params_path = sys.argv[1]
+# FFmpeg only needs to report errors; the default log and per-frame stats would just be thrown away.
+QUIET_ARGS = ['-loglevel', 'error', '-nostats']
+
+# Alpha-capable encoders for transparent fades, with the container used for binary output.
+# 8-bit FFV1 and QuickTime RLE move far less pixel data than 10-bit 4:4:4 ProRes.
+TRANSPARENCY_CODECS = {
+    'prores': (['-c:v', 'prores_ks', '-pix_fmt', 'yuva444p10le'], '.mov'),
+    'ffv1': (['-c:v', 'ffv1', '-pix_fmt', 'yuva420p', '-level', '3', '-slices', '16'], '.mkv'),
+    'qtrle': (['-c:v', 'qtrle', '-pix_fmt', 'argb'], '.mov'),
+}
+
+# How much of the input to ask the kernel to start reading before FFmpeg opens it: the header and
+# the opening GOPs. Prefetching a whole multi-gigabyte file would only push other data out of the cache.
+PREFETCH_BYTES = 64 * 1024 * 1024
+
+def prefetch_input(file_path):
+    """Hints the kernel to start reading the head of the input into the page cache (POSIX only)."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
     try:
-        with open(params_path, 'r') as f:
-            params = json.load(f)
-    except Exception as e:
-        print(json.dumps({"error": f"Failed to read or parse parameters file: {e}"}))
-        sys.exit(1)
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        # WILLNEED fills the shared page cache, so it helps FFmpeg's own file handle too. Read-pattern
+        # hints like SEQUENTIAL only apply to this handle, and FFmpeg already reads sequentially.
+        os.posix_fadvise(fd, 0, PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# The main video and every audio track; FFmpeg on its own keeps only one audio stream.
+STREAM_MAP_ARGS = ['-map', '0:v:0', '-map', '0:a?']
+# Containers whose index can be moved to the front for progressive playback
+FASTSTART_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+
+def file_output_args(output_path, source_index=0):
+    """Returns the arguments that carry the source's metadata, chapters and (for .mkv) subtitles into a file output."""
+    ext = os.path.splitext(output_path)[1].lower()
+    args = ['-map_metadata', str(source_index), '-map_chapters', str(source_index)]
+    if ext == '.mkv':
+        # Matroska takes any subtitle codec; MP4/MOV would reject most of them
+        args.extend(['-map', f'{source_index}:s?', '-c:s', 'copy'])
+    if ext in FASTSTART_EXTENSIONS:
+        args.extend(['-movflags', '+faststart'])
+    return args
+
+# Stream properties a re-encoded segment must share with the source before the two can be joined by
+# stream copy. Players keep the first segment's SPS/PPS (the extradata), so it must be byte-identical.
+SPLICE_KEYS = ('codec_name', 'pix_fmt', 'profile', 'level', 'time_base', 'r_frame_rate', 'extradata_hash')
+
+def get_stream_signature(file_path):
+    """Returns the SPLICE_KEYS properties of the first video stream."""
+    command = [
+        FFPROBE, '-v', 'error', '-select_streams', 'v:0', '-show_data_hash', 'sha256',
+        '-show_entries', 'stream=' + ','.join(SPLICE_KEYS), '-of', 'json', file_path
+    ]
+    result = run_command(command)
+    streams = json.loads(result.stdout).get('streams') or [{}]
+    return {key: streams[0].get(key) for key in SPLICE_KEYS}
+
+def get_keyframe_times(file_path):
+    """Lists the keyframe timestamps of the first video stream, read from packet flags without decoding."""
+    command = [
+        FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', file_path
+    ]
+    result = run_command(command)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
 
+def plan_smart_render(transition_type, fade_duration, fade_color, video_duration, keyframes):
+    """Splits the video at keyframes into (start, end, filter) segments, where only segments with a filter are re-encoded.
+
+    Each re-encoded end runs to the nearest keyframe outside its fade so everything in between can be stream-copied.
+    Returns None when no keyframe allows that.
+    """
+    d = min(fade_duration, video_duration / 2) if transition_type == 'fadeInOut' else min(fade_duration, video_duration)
+    copy_start, copy_end = 0.0, video_duration
+    if transition_type in ('fadeIn', 'fadeInOut'):
+        copy_start = next((k for k in keyframes if k >= d), None)
+    if transition_type in ('fadeOut', 'fadeInOut'):
+        copy_end = next((k for k in reversed(keyframes) if 0 < k <= video_duration - d), None)
+    if copy_start is None or copy_end is None or copy_start >= copy_end:
+        return None
+
+    segments = []
+    if copy_start > 0:
+        segments.append((0.0, copy_start, f"fade=t=in:st=0:d={d}:color={fade_color}"))
+    segments.append((copy_start, copy_end if copy_end < video_duration else None, None))
+    if copy_end < video_duration:
+        # The segment starts at zero, so the fade starts where it would have, minus the cut point
+        st = video_duration - d - copy_end
+        segments.append((copy_end, None, f"fade=t=out:st={st}:d={d}:color={fade_color}"))
+    return segments
+
+def render_segments(input_path, segments, encode_args, output_path, source_signature):
+    """Renders each video segment to a temp file, re-encoding only the faded ones, then joins them with the concat demuxer.
+
+    Returns False, leaving the output unwritten, when a re-encoded segment doesn't match the source's
+    stream signature and so can't be spliced with it.
+    """
+    # Segments use the source's container so copied packets keep their timestamps' time base
+    ext = os.path.splitext(input_path)[1].lower()
+    segment_ext = ext if ext in ('.mp4', '.mov', '.mkv') else '.mkv'
+    segment_args = ['-map', '0:v:0', '-an'] # Audio is taken from the source in one piece when joining
+    if segment_ext != '.mkv':
+        timescale = (source_signature.get('time_base') or '').partition('/')[2]
+        if timescale:
+            segment_args.extend(['-video_track_timescale', timescale])
+
+    work_dir = tempfile.mkdtemp(prefix='yak_fade_')
+    try:
+        list_lines = []
+        for i, (start, end, video_filter) in enumerate(segments):
+            segment_path = os.path.join(work_dir, f"segment_{i}{segment_ext}")
+            command = [FFMPEG, '-y'] + QUIET_ARGS
+            if start > 0:
+                command.extend(['-ss', str(start)]) # Input-side seek lands exactly on the keyframe
+            if end is not None:
+                command.extend(['-t', str(end - start)])
+            command.extend(['-i', input_path])
+            if video_filter:
+                command.extend(['-vf', video_filter] + encode_args)
+            else:
+                command.extend(['-c:v', 'copy'])
+            command.extend(segment_args + [segment_path])
+            run_ffmpeg(command)
+            if video_filter and get_stream_signature(segment_path) != source_signature:
+                return False
+            escaped_path = segment_path.replace("'", "'\\''")
+            list_lines.append(f"file '{escaped_path}'\n")
+
+        list_path = os.path.join(work_dir, 'segments.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            f.writelines(list_lines)
+        # The source supplies the audio, uncut, along with its metadata and chapters
+        command = [FFMPEG, '-y'] + QUIET_ARGS + ['-f', 'concat', '-safe', '0', '-i', list_path, '-i', input_path]
+        command.extend(['-map', '0:v', '-map', '1:a?', '-c', 'copy'] + file_output_args(output_path, source_index=1) + [output_path])
+        run_ffmpeg(command)
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def fade_in_filter(d, video_duration, c):
+    # Clamp so a fade longer than the clip still reaches full brightness by its last frame
+    d = min(d, video_duration)
+    return f"fade=t=in:st=0:d={d}:color={c}"
+
+def fade_out_filter(d, video_duration, c):
+    d = min(d, video_duration)
+    return f"fade=t=out:st={video_duration - d}:d={d}:color={c}"
+
+def fade_in_out_filter(d, video_duration, c):
+    d = min(d, video_duration / 2)
+    # Two fade instances cost no more than one combined expression: each only touches the frames
+    # inside its own window and passes every other frame through without reading its pixels.
+    return f"fade=t=in:st=0:d={d}:color={c},fade=t=out:st={video_duration - d}:d={d}:color={c}"
+
+# Filter builder for each transition type
+_FADE_FILTERS = {
+    'fadeIn': fade_in_filter,
+    'fadeOut': fade_out_filter,
+    'fadeInOut': fade_in_out_filter,
+}
+
+def build_fade_filter(transition_type, fade_duration, fade_color, video_duration):
+    """Builds the fade filter chain, clamping the fade to the video's duration."""
+    return _FADE_FILTERS[transition_type](fade_duration, video_duration, fade_color)
+
+def get_encode_args(params, fade_color):
+    """Returns the video encoder arguments and the container extension used for binary output."""
+    # Handle transparency
+    if fade_color == 'transparent':
+        encode_args, ext = TRANSPARENCY_CODECS.get(params.get('transparencyCodec'), TRANSPARENCY_CODECS['prores'])
+        encode_args = list(encode_args)
+    else:
+        encode_args, ext = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'], ".mp4"
+        # FFmpeg's default 'medium' preset is far slower than a fade pass needs
+        encode_args.extend(['-preset', params.get('x264Preset') or 'veryfast', '-crf', str(params.get('x264Crf', 20))])
+    encode_args.extend(['-threads', str(int(params.get('threads') or 0))]) # 0 lets the encoder use every core
+    return encode_args, ext
+
+def run(params):
+    """Runs the function for one set of parameters and returns its JSON result, or None if it was streamed to stdout."""
     try:
         input_path = get_file_path(params, 'input')
         transition_type = params.get('transitionType', 'fadeIn')
         fade_color = params.get('fadeColor', 'black')
         fade_duration = float(params.get('fadeDuration', 1))
+        smart_render = params.get('smartRender', False) and fade_color != 'transparent'
+        if transition_type not in _FADE_FILTERS:
+            raise ValueError(f"Unknown transition type: {transition_type}")
         
-        if not os.path.exists(input_path):
+        # One stat both checks the input exists and keys the duration cache
+        try:
+            input_stat = os.stat(input_path)
+        except FileNotFoundError:
             raise ValueError(f"Input file not found at path: {input_path}")
 
-        video_duration = get_media_duration(input_path)
+        # Every fade is clamped to the clip, so the duration is always needed; repeat runs hit the cache
+        video_duration = get_media_duration(input_path, input_stat)
         if video_duration is None:
             raise ValueError("Could not determine the duration of the input video file.")
 
     except (ValueError, TypeError) as e:
-        print(json.dumps({"error": str(e)}))
+        write_json({"error": str(e)})
         sys.exit(1)
 
     # --- Build Filter Complex ---
-    video_filter = ""
-    if transition_type == 'fadeIn':
-        d = min(fade_duration, video_duration)
-        video_filter = f"fade=t=in:st=0:d={d}:color={fade_color}"
-    elif transition_type == 'fadeOut':
-        d = min(fade_duration, video_duration)
-        st = video_duration - d
-        video_filter = f"fade=t=out:st={st}:d={d}:color={fade_color}"
-    elif transition_type == 'fadeInOut':
-        d = min(fade_duration, video_duration / 2)
-        st_out = video_duration - d
-        video_filter = f"fade=t=in:st=0:d={d}:color={fade_color},fade=t=out:st={st_out}:d={d}:color={fade_color}"
+    video_filter = build_fade_filter(transition_type, fade_duration, fade_color, video_duration)
     
     # --- Determine Output Path and Execute ---
     output_as_file_path = params.get('outputAsFilePath', True)
     output_path = None
+    pipe_muxer = None
+    hand_off = False
     
     try:
+        encode_args, default_ext = get_encode_args(params, fade_color)
+
+        if params.get('emitFilterOnly'):
+            # Let a caller fold this fade into a larger filter graph instead of running a separate encode
+            return {"filter": video_filter, "codec_args": encode_args, "duration": video_duration}
+
+        prefetch_input(input_path)
+
+        # Smart rendering re-encodes only the faded ends and copies the rest, which needs the copied
+        # H.264 to match what libx264 produces here; render_segments checks that before joining.
+        segments = None
+        if smart_render:
+            source_signature = get_stream_signature(input_path)
+            if source_signature['codec_name'] == 'h264' and source_signature['pix_fmt'] == 'yuv420p':
+                segments = plan_smart_render(transition_type, fade_duration, fade_color, video_duration, get_keyframe_times(input_path))
+
         if output_as_file_path:
             output_path = params.get('outputFilePath')
             if not output_path: raise ValueError("Output file path is required.")
         else:
-            temp_dir = tempfile.gettempdir()
-            ext = ".mov" if fade_color == 'transparent' else ".mp4"
-            output_path = os.path.join(temp_dir, f"ffmpeg_fade_output{ext}")
+            ext = default_ext
+            file_name = f"ffmpeg_fade_output{ext}"
+            hand_off = params.get('binaryTransport', 'tempFile') == 'tempFile'
+            if hand_off or segments:
+                # The node runs on this host, or the concat step needs a seekable file to write to;
+                # a unique one either way, so concurrent jobs can't collide
+                output_path = make_handoff_path(file_name)
+            else:
+                # A fragmented MP4/MOV can be written to a pipe, so stream straight from FFmpeg.
+                pipe_muxer = PIPE_MUXERS[ext]
 
-        command = ['ffmpeg', '-y', '-i', input_path, '-vf', video_filter]
-        
-        # Handle transparency
-        if fade_color == 'transparent':
-            command.extend(['-c:v', 'prores_ks', '-pix_fmt', 'yuva444p10le'])
-        else:
-            command.extend(['-c:v', 'libx264', '-pix_fmt', 'yuv420p'])
+        if segments and not render_segments(input_path, segments, encode_args, output_path, source_signature):
+            # The encoder's stream parameters differ from the source's, so splicing would corrupt playback
+            sys.stderr.write("Smart render skipped: the re-encoded fade doesn't match the source stream.\n")
+            segments = None
 
-        command.extend(['-c:a', 'copy', output_path])
+        # Hardware encoding replaces libx264 for a full encode only; smart-render segments must match
+        # the copied H.264, and transparent fades need an alpha-capable codec.
+        input_args = []
+        hw_accel = params.get('hwaccel') or 'none'
+        if hw_accel != 'none' and not segments and fade_color != 'transparent':
+            codec_args = get_h264_codec_args(hw_accel, vaapi_upload=True)
+            if codec_args is not SOFTWARE_H264_ARGS:
+                encode_args = codec_args
+                input_args = ['-hwaccel', 'auto'] # Decode on the GPU when the encoder runs there too
+                if hw_accel == 'vaapi':
+                    input_args += VAAPI_INPUT_ARGS
+                    video_filter += ',' + VAAPI_UPLOAD_FILTER
 
-        is_windows = sys.platform == "win32"
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=is_windows)
+        if not segments:
+            command = [FFMPEG, '-y'] + QUIET_ARGS + input_args + ['-i', input_path, '-vf', video_filter] + encode_args + ['-c:a', 'copy'] + STREAM_MAP_ARGS
+            if pipe_muxer:
+                command.extend(pipe_muxer + ['pipe:1'])
+                stream_ffmpeg_output(command, file_name)
+                return
+            command.extend(file_output_args(output_path) + [output_path])
+            run_ffmpeg(command)
         
         if not output_as_file_path:
-            with open(output_path, 'rb') as f:
-                binary_data = f.read()
-            encoded_data = base64.b64encode(binary_data).decode('utf-8')
-            print(json.dumps({"binary_data": encoded_data, "file_name": os.path.basename(output_path)}))
+            if hand_off or os.path.getsize(output_path) > MAX_INLINE_OUTPUT_BYTES:
+                # Handed over by path, or too big to inline; the node reads the file itself and deletes it afterwards
+                result = {"output_path": output_path, "file_name": file_name, "delete_after": True}
+                output_path = None # Leave the file for the node
+                return result
+            write_binary_output(output_path)
         else:
-             print(json.dumps({"output_path": output_path}))
+             return {"output_path": output_path}
 
     except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
         error_message = f"FFmpeg command failed. Stderr: {e.stderr}" if hasattr(e, 'stderr') else str(e)
-        print(json.dumps({"error": error_message, "command": " ".join(command if 'command' in locals() else [])}))
+        # Report the command that actually failed, which may be one of the smart-render steps
+        failed_command = e.cmd if isinstance(e, subprocess.CalledProcessError) else (command if 'command' in locals() else [])
+        write_json({"error": error_message, "command": " ".join(failed_command)})
         sys.exit(1)
     finally:
-        if not output_as_file_path and 'output_path' in locals() and output_path and os.path.exists(output_path):
+        if not output_as_file_path and output_path:
             try:
                 os.remove(output_path)
+            except FileNotFoundError:
+                pass
             except OSError as e:
                 sys.stderr.write(f"Error cleaning up temporary file {output_path}: {e}\n")
 
+def main():
+    if len(sys.argv) != 2:
+        write_json({"error": "Expected a single argument: the path to the parameters JSON file."})
+        sys.exit(1)
+    
+    params_path = sys.argv[1]
+    try:
+        params = load_params(params_path)
+    except Exception as e:
+        write_json({"error": f"Failed to read or parse parameters file: {e}"})
+        sys.exit(1)
+
+    result = run(params)
+    if result is not None:
+        write_json(result)
+
 if __name__ == '__main__':
     main()
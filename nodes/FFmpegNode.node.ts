@@ -9,9 +9,9 @@ import {
     NodeOperationError,
     IDataObject,
 } from 'n8n-workflow';
-import { spawn } from 'child_process';
+import { spawn, ChildProcessWithoutNullStreams } from 'child_process';
 import * as path from 'path';
-import { promises as fs } from 'fs';
+import { promises as fs, createReadStream } from 'fs';
 import * as os from 'os'; // Needed for temporary directory
 
 // --- HELPER FUNCTION ---
@@ -31,12 +31,66 @@ interface IFFmpegFunction {
     value: string;
     uiFile: string;
     scriptFile: string;
+    worker?: boolean;
 }
 
 interface IManifest {
     functions: IFFmpegFunction[];
 }
 
+// --- PYTHON WORKER ---
+// One long-running Python process that serves every function marked "worker": true in the
+// manifest. Requests and results are single JSON lines, handled one at a time.
+class PythonWorker {
+    private process: ChildProcessWithoutNullStreams;
+    private buffer = '';
+    private stderr = '';
+    private pending: { resolve: (line: string) => void; reject: (err: Error) => void } | null = null;
+    closed = false;
+
+    constructor(workerPath: string) {
+        this.process = spawn('python', [workerPath]);
+        this.process.stdout.setEncoding('utf8');
+        this.process.stdout.on('data', (chunk: string) => {
+            // Only the new chunk can contain the end of the line we are waiting for
+            const newline = chunk.indexOf('\n');
+            this.buffer += chunk;
+            if (newline === -1 || !this.pending) return;
+            const end = this.buffer.length - chunk.length + newline;
+            const line = this.buffer.slice(0, end);
+            this.buffer = this.buffer.slice(end + 1);
+            const { resolve } = this.pending;
+            this.pending = null;
+            this.stderr = '';
+            resolve(line.trim());
+        });
+        this.process.stderr.on('data', (data) => (this.stderr += data.toString()));
+        this.process.on('close', (code) => this.fail(new Error(this.stderr || `Worker exited with code ${code}`)));
+        this.process.on('error', (err) => this.fail(new Error(`Failed to start worker: ${err.message}`)));
+    }
+
+    private fail(err: Error) {
+        this.closed = true;
+        if (this.pending) {
+            const { reject } = this.pending;
+            this.pending = null;
+            reject(err);
+        }
+    }
+
+    run(op: string, params: IDataObject): Promise<string> {
+        if (this.closed) return Promise.reject(new Error('Worker is not running'));
+        return new Promise<string>((resolve, reject) => {
+            this.pending = { resolve, reject };
+            this.process.stdin.write(JSON.stringify({ op, params }) + '\n');
+        });
+    }
+
+    close() {
+        this.process.stdin.end();
+    }
+}
+
 // --- NODE IMPLEMENTATION ---
 export class FFmpegNode implements INodeType {
     description: INodeTypeDescription = {
@@ -174,137 +228,177 @@ export class FFmpegNode implements INodeType {
         const returnData: INodeExecutionData[] = [];
         const repoRoot = path.join(__dirname, '..', '..');
         let tempFiles: string[] = [];
+        let worker: PythonWorker | null = null;
 
-        for (let itemIndex = 0; itemIndex < items.length; itemIndex++) {
-            try {
-                const selectedFunctionValue = this.getNodeParameter('selectedFunction', itemIndex, '') as string;
-                if (!selectedFunctionValue) throw new NodeOperationError(this.getNode(), 'No function selected.');
-
-                const manifestPath = path.join(repoRoot, 'ffmpeg_node_manifest.json');
-                const manifest = await readJson<IManifest>(manifestPath);
-                const selectedFunction = manifest.functions.find((f: IFFmpegFunction) => f.value === selectedFunctionValue);
-                if (!selectedFunction) throw new NodeOperationError(this.getNode(), `Function '${selectedFunctionValue}' not found.`);
-
-                const scriptPath = path.join(repoRoot, selectedFunction.scriptFile);
-                const uiStructurePath = path.join(repoRoot, selectedFunction.uiFile);
-                await fs.access(scriptPath);
-
-                const parameters: IDataObject = {};
-                const uiConfig = await readJson<{ properties?: { name: string, type: string }[] }>(uiStructurePath);
+        try {
+            for (let itemIndex = 0; itemIndex < items.length; itemIndex++) {
+                try {
+                    const selectedFunctionValue = this.getNodeParameter('selectedFunction', itemIndex, '') as string;
+                    if (!selectedFunctionValue) throw new NodeOperationError(this.getNode(), 'No function selected.');
 
-                if (uiConfig.properties && Array.isArray(uiConfig.properties)) {
-                    for (const prop of uiConfig.properties) {
-                        if (!prop.name) continue;
-                        try {
-                            parameters[prop.name] = this.getNodeParameter(prop.name, itemIndex);
-                        } catch (error) {
-                            continue;
+                    const manifestPath = path.join(repoRoot, 'ffmpeg_node_manifest.json');
+                    const manifest = await readJson<IManifest>(manifestPath);
+                    const selectedFunction = manifest.functions.find((f: IFFmpegFunction) => f.value === selectedFunctionValue);
+                    if (!selectedFunction) throw new NodeOperationError(this.getNode(), `Function '${selectedFunctionValue}' not found.`);
+
+                    const scriptPath = path.join(repoRoot, selectedFunction.scriptFile);
+                    const uiStructurePath = path.join(repoRoot, selectedFunction.uiFile);
+                    await fs.access(scriptPath);
+
+                    const parameters: IDataObject = {};
+                    const uiConfig = await readJson<{ properties?: { name: string, type: string }[] }>(uiStructurePath);
+
+                    if (uiConfig.properties && Array.isArray(uiConfig.properties)) {
+                        for (const prop of uiConfig.properties) {
+                            if (!prop.name) continue;
+                            try {
+                                parameters[prop.name] = this.getNodeParameter(prop.name, itemIndex);
+                            } catch (error) {
+                                continue;
+                            }
                         }
                     }
-                }
 
-                // **BINARY INPUT HANDLING**
-                // This logic is generic because it relies on a naming convention
-                // that all function UIs must follow for binary inputs.
-                const processedParameters = { ...parameters }; // Create a copy to modify
-
-                // Find all boolean toggles for binary data
-                const binaryToggleKeys = Object.keys(processedParameters).filter(k => k.endsWith('IsBinary'));
-
-                for (const toggleKey of binaryToggleKeys) {
-                    if (processedParameters[toggleKey] === true) {
-                        // If the toggle is on, find the corresponding property name field
-                        const prefix = toggleKey.replace('IsBinary', '');
-                        const binaryPropNameKey = `${prefix}BinaryPropertyName`;
-
-                        if (processedParameters[binaryPropNameKey]) {
-                            const binaryPropertyName = processedParameters[binaryPropNameKey] as string;
-                            
-                            // **THE FIX**
-                            // Correctly access the data for the current item from the 'items' array.
-                            const inputData = items[itemIndex];
-                            const binaryInfo = inputData.binary?.[binaryPropertyName];
-
-                            if (!binaryInfo) {
-                                throw new NodeOperationError(this.getNode(), `Binary property '${binaryPropertyName}' not found in input data.`);
+                    // **BINARY INPUT HANDLING**
+                    // This logic is generic because it relies on a naming convention
+                    // that all function UIs must follow for binary inputs.
+                    const processedParameters = { ...parameters }; // Create a copy to modify
+
+                    // Find all boolean toggles for binary data
+                    const binaryToggleKeys = Object.keys(processedParameters).filter(k => k.endsWith('IsBinary'));
+
+                    for (const toggleKey of binaryToggleKeys) {
+                        if (processedParameters[toggleKey] === true) {
+                            // If the toggle is on, find the corresponding property name field
+                            const prefix = toggleKey.replace('IsBinary', '');
+                            const binaryPropNameKey = `${prefix}BinaryPropertyName`;
+
+                            if (processedParameters[binaryPropNameKey]) {
+                                const binaryPropertyName = processedParameters[binaryPropNameKey] as string;
+                                
+                                // **THE FIX**
+                                // Correctly access the data for the current item from the 'items' array.
+                                const inputData = items[itemIndex];
+                                const binaryInfo = inputData.binary?.[binaryPropertyName];
+
+                                if (!binaryInfo) {
+                                    throw new NodeOperationError(this.getNode(), `Binary property '${binaryPropertyName}' not found in input data.`);
+                                }
+                                
+                                const binaryBuffer = await this.helpers.getBinaryDataBuffer(itemIndex, binaryPropertyName);
+                                const fileName = binaryInfo.fileName ?? `${binaryPropertyName}.bin`;
+
+                                const tempPath = path.join(os.tmpdir(), `n8n-ffmpeg-bin-${Date.now()}-${fileName}`);
+                                await fs.writeFile(tempPath, binaryBuffer);
+                                tempFiles.push(tempPath);
+
+                                // Replace the property name (e.g., 'data') with the actual temp file path.
+                                // The Python script will now receive the path it needs.
+                                processedParameters[binaryPropNameKey] = tempPath;
                             }
-                            
-                            const binaryBuffer = await this.helpers.getBinaryDataBuffer(itemIndex, binaryPropertyName);
-                            const fileName = binaryInfo.fileName ?? `${binaryPropertyName}.bin`;
-
-                            const tempPath = path.join(os.tmpdir(), `n8n-ffmpeg-bin-${Date.now()}-${fileName}`);
-                            await fs.writeFile(tempPath, binaryBuffer);
-                            tempFiles.push(tempPath);
+                        }
+                    }
 
-                            // Replace the property name (e.g., 'data') with the actual temp file path.
-                            // The Python script will now receive the path it needs.
-                            processedParameters[binaryPropNameKey] = tempPath;
+                    let scriptResult: string;
+                    if (selectedFunction.worker) {
+                        // Reuse one Python process for every item instead of starting a new one each time
+                        if (!worker || worker.closed) {
+                            worker = new PythonWorker(path.join(repoRoot, 'ffmpeg_functions', '_worker.py'));
+                        }
+                        try {
+                            scriptResult = await worker.run(selectedFunction.value, processedParameters);
+                        } catch (error) {
+                            throw new NodeOperationError(this.getNode(), `Script failed: ${(error as Error).message}`);
                         }
+                    } else {
+                        const paramsPath = path.join(os.tmpdir(), `n8n-ffmpeg-params-${Date.now()}-${itemIndex}.json`);
+                        await fs.writeFile(paramsPath, JSON.stringify(processedParameters, null, 2));
+                        tempFiles.push(paramsPath);
+
+                        scriptResult = await new Promise<string>((resolve, reject) => {
+                            const pythonProcess = spawn('python', [scriptPath, paramsPath]);
+                            let stdout = '';
+                            let stderr = '';
+                            pythonProcess.stdout.on('data', (data) => (stdout += data.toString()));
+                            pythonProcess.stderr.on('data', (data) => (stderr += data.toString()));
+                            pythonProcess.on('close', (code) => {
+                                if (code !== 0) return reject(new NodeOperationError(this.getNode(), `Script failed: ${stderr || `Exited with code ${code}`}`));
+                                resolve(stdout.trim());
+                            });
+                            pythonProcess.on('error', (err) => reject(new NodeOperationError(this.getNode(), `Failed to start script: ${err.message}`)));
+                        });
                     }
-                }
 
+                    let jsonResult: IDataObject;
+                    try {
+                        jsonResult = JSON.parse(scriptResult);
+                    } catch {
+                        // A truncated or garbled result means the script failed part-way; never pass it on as output
+                        throw new NodeOperationError(this.getNode(), `Script returned invalid output: ${scriptResult.slice(0, 500)}`);
+                    }
 
-                const paramsPath = path.join(os.tmpdir(), `n8n-ffmpeg-params-${Date.now()}-${itemIndex}.json`);
-                await fs.writeFile(paramsPath, JSON.stringify(processedParameters, null, 2));
-                tempFiles.push(paramsPath);
-
-                const scriptResult = await new Promise<string>((resolve, reject) => {
-                    const pythonProcess = spawn('python', [scriptPath, paramsPath]);
-                    let stdout = '';
-                    let stderr = '';
-                    pythonProcess.stdout.on('data', (data) => (stdout += data.toString()));
-                    pythonProcess.stderr.on('data', (data) => (stderr += data.toString()));
-                    pythonProcess.on('close', (code) => {
-                        if (code !== 0) return reject(new NodeOperationError(this.getNode(), `Script failed: ${stderr || `Exited with code ${code}`}`));
-                        resolve(stdout.trim());
-                    });
-                    pythonProcess.on('error', (err) => reject(new NodeOperationError(this.getNode(), `Failed to start script: ${err.message}`)));
-                });
-
-                let jsonResult: IDataObject;
-                try {
-                    jsonResult = JSON.parse(scriptResult);
-                } catch {
-                    jsonResult = { output: scriptResult, parseError: true };
-                }
+                    // The worker stays alive after a failed item, so errors arrive as a result line
+                    // rather than a non-zero exit code. A stream that failed part-way also ends with an
+                    // error next to its partial binary_data.
+                    if (jsonResult.error) {
+                        throw new NodeOperationError(this.getNode(), `Script failed: ${jsonResult.error}`);
+                    }
 
-                // **BINARY OUTPUT HANDLING**
-                if (jsonResult.binary_data && jsonResult.file_name) {
-                    const binaryBuffer = Buffer.from(jsonResult.binary_data as string, 'base64');
-                    const binaryData = await this.helpers.prepareBinaryData(
-                        binaryBuffer,
-                        jsonResult.file_name as string,
-                    );
-                    
-                    const executionData: INodeExecutionData = {
-                        json: {}, // Can add other non-binary results here if needed
-                        binary: { data: binaryData },
-                        pairedItem: { item: itemIndex },
-                    };
-                    returnData.push(executionData);
-
-                } else {
-                    // Standard non-binary output
-                    returnData.push({ json: jsonResult, pairedItem: { item: itemIndex } });
-                }
+                    // **BINARY OUTPUT HANDLING**
+                    if (jsonResult.binary_data && jsonResult.file_name) {
+                        const binaryBuffer = Buffer.from(jsonResult.binary_data as string, 'base64');
+                        const binaryData = await this.helpers.prepareBinaryData(
+                            binaryBuffer,
+                            jsonResult.file_name as string,
+                        );
+                        
+                        const executionData: INodeExecutionData = {
+                            json: {}, // Can add other non-binary results here if needed
+                            binary: { data: binaryData },
+                            pairedItem: { item: itemIndex },
+                        };
+                        returnData.push(executionData);
+
+                    } else if (jsonResult.output_path && jsonResult.delete_after) {
+                        // The script left the output in a temp file; stream it in instead of decoding base64.
+                        const outputPath = jsonResult.output_path as string;
+                        tempFiles.push(outputPath);
+                        const binaryData = await this.helpers.prepareBinaryData(
+                            createReadStream(outputPath),
+                            (jsonResult.file_name as string) ?? path.basename(outputPath),
+                        );
+
+                        returnData.push({
+                            json: {},
+                            binary: { data: binaryData },
+                            pairedItem: { item: itemIndex },
+                        });
+
+                    } else {
+                        // Standard non-binary output
+                        returnData.push({ json: jsonResult, pairedItem: { item: itemIndex } });
+                    }
 
 
-            } catch (error) {
-                if (this.continueOnFail()) {
-                    returnData.push({ json: { error: (error as Error).message }, pairedItem: { item: itemIndex } });
-                    continue;
-                }
-                throw error;
-            } finally {
-                for (const filePath of tempFiles) {
-                    try {
-                        await fs.unlink(filePath);
-                    } catch (e) {
-                        console.error(`Could not clean up temp file ${filePath}:`, e);
+                } catch (error) {
+                    if (this.continueOnFail()) {
+                        returnData.push({ json: { error: (error as Error).message }, pairedItem: { item: itemIndex } });
+                        continue;
+                    }
+                    throw error;
+                } finally {
+                    for (const filePath of tempFiles) {
+                        try {
+                            await fs.unlink(filePath);
+                        } catch (e) {
+                            console.error(`Could not clean up temp file ${filePath}:`, e);
+                        }
                     }
+                    tempFiles = [];
                 }
-                tempFiles = [];
             }
+        } finally {
+            worker?.close();
         }
         return this.prepareOutputData(returnData);
     }